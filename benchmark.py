@@ -0,0 +1,463 @@
+"""
+Benchmark the pipeline stages on synthetic Manifold-shaped data.
+
+Generates bets, contracts and comments with the schemas from schemas.py, where a few users
+and markets account for most of the bets like in the real dumps, then times each stage in
+a fresh process and records its throughput and peak RSS. Results can be saved as a
+baseline and later runs compared against it, e.g.
+
+    python benchmark.py --bets 1000000 --save-baseline benchmark_baseline.json
+    python benchmark.py --bets 1000000 --baseline benchmark_baseline.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from calculate_profits import calculate_profits, get_profit_metrics
+from churn import SNAPSHOT_DATE, calculate_bet_metrics, calculate_most_recent_streak
+from churn_features import DAY_MS, calculate_all_metrics, calculate_all_streaks
+from convert_json_to_ndjson import convert_json_to_ndjson
+from datasets import read_table
+from instrumentation import peak_rss
+from json_to_parquet import iter_json_array
+from ndjson_to_parquet import stream_ndjson_to_parquet_bets, write_rows_to_parquet
+from schemas import BETS, COMMENTS, CONTRACTS
+
+DATA_DIR = Path("manifold_datasets/benchmark")
+START_MS = int(pd.Timestamp("2022-01-01").timestamp() * 1000)
+END_MS = int(pd.Timestamp("2024-07-06").timestamp() * 1000)
+CHUNK_SIZE = 1_000_000
+TOPICS = [f"topic-{i}" for i in range(200)]
+ID_ALPHABET = np.frombuffer(
+    b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz", dtype=np.uint8
+)
+
+
+def _random_ids(rng, n, length=20):
+    codes = rng.integers(0, len(ID_ALPHABET), size=(n, length))
+    return ID_ALPHABET[codes].view(f"S{length}").ravel().astype(str)
+
+
+def _long_tailed_weights(rng, n, shape=1.1):
+    """
+    Pareto distributed sampling weights, so a few items get most of the samples.
+    """
+    weights = rng.pareto(shape, n) + 1
+    return weights / weights.sum()
+
+
+def _categories(indices, dictionary):
+    return pa.DictionaryArray.from_arrays(
+        pa.array(indices, type=pa.int32()), dictionary
+    )
+
+
+def generate(
+    data_dir,
+    num_bets,
+    num_users=None,
+    num_contracts=None,
+    num_comments=None,
+    seed=0,
+    chunk_size=CHUNK_SIZE,
+):
+    """
+    Write bets.parquet, contracts.parquet and comments.parquet into data_dir.
+
+    Every user is active from a random start date for a random span, and bets on markets
+    created before the bet. Bets are generated and written chunk_size at a time, so memory
+    doesn't grow with num_bets.
+    """
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    num_users = num_users or max(num_bets // 50, 10)
+    num_contracts = num_contracts or max(num_bets // 100, 10)
+    num_comments = num_comments or num_bets // 10
+    rng = np.random.default_rng(seed)
+
+    user_ids = pa.array(_random_ids(rng, num_users))
+    user_weights = _long_tailed_weights(rng, num_users)
+    user_starts = rng.integers(START_MS, END_MS, num_users)
+    user_spans = rng.lognormal(np.log(60), 1.5, num_users) * DAY_MS
+
+    contract_ids = pa.array(_random_ids(rng, num_contracts))
+    contract_weights = _long_tailed_weights(rng, num_contracts)
+    contract_times = rng.integers(START_MS, END_MS - DAY_MS, num_contracts)
+    is_resolved = rng.random(num_contracts) < 0.6
+    num_topics = rng.integers(0, 4, num_contracts)
+    topic_weights = _long_tailed_weights(rng, len(TOPICS))
+    contracts = pa.table(
+        {
+            "id": contract_ids,
+            "creatorId": _categories(
+                rng.choice(num_users, num_contracts, p=user_weights), user_ids
+            ),
+            "totalLiquidity": rng.integers(0, 10_000, num_contracts),
+            "volume": rng.integers(0, 1_000_000, num_contracts),
+            "outcomeType": _categories(
+                rng.choice(3, num_contracts, p=[0.8, 0.15, 0.05]),
+                pa.array(["BINARY", "MULTIPLE_CHOICE", "PSEUDO_NUMERIC"]),
+            ),
+            "groupSlugs": pa.ListArray.from_arrays(
+                np.r_[0, np.cumsum(num_topics)].astype(np.int32),
+                pa.array(
+                    np.array(TOPICS)[
+                        rng.choice(len(TOPICS), num_topics.sum(), p=topic_weights)
+                    ]
+                ),
+            ),
+            "isResolved": is_resolved,
+            "resolution": np.where(
+                is_resolved,
+                rng.choice(["YES", "NO", "CANCEL", "MKT"], num_contracts),
+                "",
+            ),
+            "createdTime": contract_times,
+            "resolutionTime": pa.array(
+                contract_times + rng.integers(DAY_MS, 365 * DAY_MS, num_contracts),
+                mask=~is_resolved,
+            ),
+            "closeTime": contract_times + 365 * DAY_MS,
+        },
+        schema=CONTRACTS.arrow_schema,
+    )
+    pq.write_table(contracts, data_dir / "contracts.parquet")
+
+    outcomes = pa.array(["YES", "NO"])
+    with pq.ParquetWriter(data_dir / "bets.parquet", BETS.arrow_schema) as writer:
+        for start in tqdm(range(0, num_bets, chunk_size), desc="Generating bets"):
+            n = min(chunk_size, num_bets - start)
+            users = rng.choice(num_users, n, p=user_weights)
+            markets = rng.choice(num_contracts, n, p=contract_weights)
+            times = user_starts[users] + rng.exponential(user_spans[users]).astype(
+                np.int64
+            )
+            times = np.clip(np.maximum(times, contract_times[markets]), None, END_MS)
+            amounts = rng.integers(-100, 500, n)
+            writer.write_table(
+                pa.table(
+                    {
+                        "userId": _categories(users, user_ids),
+                        "contractId": _categories(markets, contract_ids),
+                        "amount": amounts,
+                        "outcome": _categories(rng.integers(0, 2, n), outcomes),
+                        "shares": np.abs(amounts) * rng.uniform(0.5, 3, n),
+                        "createdTime": times,
+                        "isRedemption": rng.random(n) < 0.03,
+                    },
+                    schema=BETS.arrow_schema,
+                )
+            )
+
+    comment_contracts = rng.choice(num_contracts, num_comments, p=contract_weights)
+    comments = pa.table(
+        {
+            "id": _random_ids(rng, num_comments),
+            "userId": _categories(
+                rng.choice(num_users, num_comments, p=user_weights), user_ids
+            ),
+            "contractId": _categories(comment_contracts, contract_ids),
+            "likes": rng.geometric(0.5, num_comments) - 1,
+            "createdTime": np.clip(
+                contract_times[comment_contracts]
+                + rng.exponential(30 * DAY_MS, num_comments).astype(np.int64),
+                None,
+                END_MS,
+            ),
+            "content": np.full(num_comments, "Synthetic comment"),
+        },
+        schema=COMMENTS.arrow_schema,
+    )
+    pq.write_table(comments, data_dir / "comments.parquet")
+
+
+def write_json_samples(data_dir, num_rows):
+    """
+    Write the first num_rows bets as bets.json and bets.ndjson, as input to the converters.
+    """
+    data_dir = Path(data_dir)
+    batch = next(
+        pq.ParquetFile(data_dir / "bets.parquet").iter_batches(batch_size=num_rows)
+    )
+    lines = batch.to_pandas().to_json(orient="records", lines=True).splitlines()
+    (data_dir / "bets.ndjson").write_text("\n".join(lines) + "\n")
+    (data_dir / "bets.json").write_text("[" + ",\n".join(lines) + "]")
+
+
+def _sample_users(bets, num_users):
+    user_ids = bets["userId"].unique()
+    rng = np.random.default_rng(0)
+    return rng.choice(user_ids, min(num_users, len(user_ids)), replace=False)
+
+
+def _read_bets(data_dir):
+    return read_table(data_dir / "bets.parquet")
+
+
+def _read_churn_inputs(data_dir):
+    contracts = read_table(
+        data_dir / "contracts.parquet", columns=["id", "creatorId", "createdTime"]
+    )
+    bets = read_table(
+        data_dir / "bets.parquet", columns=["userId", "contractId", "createdTime"]
+    )
+    comments = read_table(
+        data_dir / "comments.parquet", columns=["userId", "likes", "createdTime"]
+    )
+    for df in [contracts, bets, comments]:
+        df["createdTime"] = pd.to_datetime(df["createdTime"], unit="ms")
+    return bets[bets["contractId"].isin(contracts["id"])], contracts, comments
+
+
+def bench_convert_json_to_ndjson(data_dir, sample_users):
+    start = time.perf_counter()
+    convert_json_to_ndjson(data_dir / "bets.json", data_dir / "out.ndjson")
+    seconds = time.perf_counter() - start
+    with open(data_dir / "out.ndjson") as f:
+        return seconds, sum(1 for _ in f)
+
+
+def bench_ndjson_to_parquet(data_dir, sample_users):
+    start = time.perf_counter()
+    stream_ndjson_to_parquet_bets(data_dir / "bets.ndjson", data_dir / "out.parquet")
+    seconds = time.perf_counter() - start
+    return seconds, pq.read_metadata(data_dir / "out.parquet").num_rows
+
+
+def bench_json_to_parquet(data_dir, sample_users):
+    start = time.perf_counter()
+    write_rows_to_parquet(
+        iter_json_array(data_dir / "bets.json"), data_dir / "out.parquet", "bets"
+    )
+    seconds = time.perf_counter() - start
+    return seconds, pq.read_metadata(data_dir / "out.parquet").num_rows
+
+
+def bench_calculate_profits(data_dir, sample_users):
+    contracts = read_table(data_dir / "contracts.parquet")
+    bets = _read_bets(data_dir)
+    start = time.perf_counter()
+    calculate_profits(contracts, bets)
+    return time.perf_counter() - start, len(bets)
+
+
+def bench_get_profit_metrics(data_dir, sample_users):
+    contracts = read_table(data_dir / "contracts.parquet")
+    contracts = contracts[contracts["outcomeType"].str.upper() == "BINARY"]
+    contracts = contracts.set_index("id").to_dict(orient="index")
+    bets = _read_bets(data_dir)
+    bets = bets[bets["userId"].isin(_sample_users(bets, sample_users))]
+    bets = bets[bets["contractId"].isin(list(contracts))]
+    groups = [
+        (contracts[contract_id], group.to_dict(orient="records"))
+        for (_, contract_id), group in bets.groupby(
+            ["userId", "contractId"], observed=True
+        )
+    ]
+    start = time.perf_counter()
+    for contract, contract_bets in groups:
+        get_profit_metrics(contract, contract_bets)
+    return time.perf_counter() - start, len(bets)
+
+
+def bench_churn_features(data_dir, sample_users):
+    bets, contracts, comments = _read_churn_inputs(data_dir)
+    start = time.perf_counter()
+    calculate_all_metrics(bets, contracts, comments, SNAPSHOT_DATE)
+    return time.perf_counter() - start, len(bets)
+
+
+def bench_calculate_bet_metrics(data_dir, sample_users):
+    bets, _, _ = _read_churn_inputs(data_dir)
+    bets = bets[bets["userId"].isin(_sample_users(bets, sample_users))]
+    groups = [group for _, group in bets.groupby("userId", observed=True)]
+    start = time.perf_counter()
+    for user_data in groups:
+        calculate_bet_metrics(user_data, user_data["createdTime"].max())
+    return time.perf_counter() - start, len(bets)
+
+
+def bench_calculate_most_recent_streak(data_dir, sample_users):
+    bets, _, _ = _read_churn_inputs(data_dir)
+    bets = bets[bets["userId"].isin(_sample_users(bets, sample_users))]
+    groups = [
+        group["createdTime"] for _, group in bets.groupby("userId", observed=True)
+    ]
+    start = time.perf_counter()
+    for betting_dates in groups:
+        calculate_most_recent_streak(betting_dates)
+    return time.perf_counter() - start, len(bets)
+
+
+def bench_calculate_all_streaks(data_dir, sample_users):
+    bets = read_table(data_dir / "bets.parquet", columns=["userId", "createdTime"])
+    codes, user_ids = pd.factorize(bets["userId"])
+    times = bets["createdTime"].to_numpy(dtype=np.int64) * 10**6
+    order = np.lexsort((times, codes))
+    counts = np.bincount(codes, minlength=len(user_ids))
+    ends = np.cumsum(counts)
+    start = time.perf_counter()
+    calculate_all_streaks(times[order], ends - counts, ends)
+    return time.perf_counter() - start, len(bets)
+
+
+STAGES = {
+    "convert_json_to_ndjson": bench_convert_json_to_ndjson,
+    "ndjson_to_parquet": bench_ndjson_to_parquet,
+    "json_to_parquet": bench_json_to_parquet,
+    "calculate_profits": bench_calculate_profits,
+    "get_profit_metrics": bench_get_profit_metrics,
+    "churn_features": bench_churn_features,
+    "calculate_bet_metrics": bench_calculate_bet_metrics,
+    "calculate_most_recent_streak": bench_calculate_most_recent_streak,
+    "calculate_all_streaks": bench_calculate_all_streaks,
+}
+
+
+def _run_stage(name, data_dir, sample_users):
+    seconds, rows = STAGES[name](Path(data_dir), sample_users)
+    return {
+        "seconds": seconds,
+        "rows": rows,
+        "rowsPerSecond": rows / seconds if seconds > 0 else None,
+        "peakRssBytes": peak_rss(),
+    }
+
+
+def run_stage(name, data_dir, sample_users):
+    """
+    Run a stage in a fresh process, so its peak RSS isn't inflated by earlier stages.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_stage, name, data_dir, sample_users).result()
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print each stage's throughput against the baseline, and return the stages whose
+    throughput dropped by more than tolerance times.
+    """
+    if results["config"] != baseline["config"]:
+        print("warning: the baseline was run with a different configuration")
+    regressions = []
+    print(f"{'stage':<30} {'baseline rows/s':>16} {'rows/s':>16} {'slowdown':>9}")
+    for name, stage in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["rowsPerSecond"]
+        after = stage["rowsPerSecond"]
+        if not before or not after:
+            continue
+        slowdown = before / after
+        print(f"{name:<30} {before:>16,.0f} {after:>16,.0f} {slowdown:>9.2f}")
+        if slowdown > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(
+    num_bets=100_000,
+    seed=0,
+    data_dir=DATA_DIR,
+    stages=tuple(STAGES),
+    sample_users=200,
+    json_rows=100_000,
+    output=None,
+    baseline=None,
+    save_baseline=None,
+    tolerance=1.25,
+):
+    data_dir = Path(data_dir) / f"{num_bets}-{seed}"
+    config = {"bets": num_bets, "seed": seed, "sampleUsers": sample_users}
+    if not (data_dir / "comments.parquet").exists():
+        generate(data_dir, num_bets, seed=seed)
+    if not (data_dir / "bets.json").exists():
+        write_json_samples(data_dir, min(json_rows, num_bets))
+
+    results = {
+        "config": config,
+        "machine": {"python": sys.version.split()[0], "platform": platform.platform()},
+        "stages": {},
+    }
+    for name in stages:
+        stage = run_stage(name, data_dir, sample_users)
+        results["stages"][name] = stage
+        print(
+            f"{name}: {stage['seconds']:.3f}s, {stage['rows']} rows, "
+            f"{stage['rowsPerSecond'] or 0:,.0f} rows/s, "
+            f"{stage['peakRssBytes'] / 1024**2:,.0f} MiB peak RSS"
+        )
+
+    if output is not None:
+        Path(output).write_text(json.dumps(results, indent=2))
+    if save_baseline is not None:
+        Path(save_baseline).write_text(json.dumps(results, indent=2))
+    if baseline is not None:
+        regressions = compare(
+            results, json.loads(Path(baseline).read_text()), tolerance
+        )
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--bets", type=int, default=100_000, help="number of bets")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=str(DATA_DIR))
+    parser.add_argument(
+        "--stages", nargs="+", choices=list(STAGES), default=list(STAGES)
+    )
+    parser.add_argument(
+        "--sample-users",
+        type=int,
+        default=200,
+        help="users to run the per-user reference functions on",
+    )
+    parser.add_argument(
+        "--json-rows",
+        type=int,
+        default=100_000,
+        help="bets in the JSON files the converters are run on",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", help="save the results as a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.25,
+        help="slowdown over the baseline that counts as a regression",
+    )
+    args = parser.parse_args()
+    sys.exit(
+        main(
+            num_bets=args.bets,
+            seed=args.seed,
+            data_dir=args.data_dir,
+            stages=args.stages,
+            sample_users=args.sample_users,
+            json_rows=args.json_rows,
+            output=args.output,
+            baseline=args.baseline,
+            save_baseline=args.save_baseline,
+            tolerance=args.tolerance,
+        )
+    )
@@ -0,0 +1,123 @@
+"""
+On-disk cache of tables derived from the converted dumps.
+
+A function decorated with `cached` stores the DataFrame it returns as an Arrow IPC file,
+keyed on a fingerprint of its input files, its other arguments, and a version number that
+is bumped whenever the function changes. Later calls with the same key memory-map the file
+instead of recomputing it. The least recently used entries are evicted once the cache
+grows beyond its size cap.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+
+from pyarrow import feather
+
+CACHE_DIR = Path("manifold_datasets/cache")
+MAX_BYTES = 8 * 1024**3
+
+_settings = {"directory": CACHE_DIR, "max_bytes": MAX_BYTES}
+
+
+def configure(directory=CACHE_DIR, max_bytes=MAX_BYTES):
+    """
+    Set where entries are stored and how large the cache can grow. A directory of None
+    turns caching off.
+    """
+    _settings["directory"] = None if directory is None else Path(directory)
+    _settings["max_bytes"] = max_bytes
+
+
+def _file_fingerprint(path, digest):
+    stat = path.stat()
+    digest.update(f"{path.resolve()}:{stat.st_size}".encode())
+    with open(path, "rb") as f:
+        # The footer of a Parquet file holds the statistics of every column chunk, so it
+        # changes whenever the data does
+        f.seek(max(stat.st_size - 8, 0))
+        tail = f.read(8)
+        if tail[4:] == b"PAR1":
+            footer_size = int.from_bytes(tail[:4], "little")
+            f.seek(max(stat.st_size - 8 - footer_size, 0))
+            digest.update(f.read(footer_size))
+        else:
+            digest.update(str(stat.st_mtime_ns).encode())
+
+
+def fingerprint(path):
+    """
+    Digest of a file, or every file in a directory, from its size and Parquet footer.
+    """
+    path = Path(path)
+    digest = hashlib.sha256()
+    files = (
+        sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path]
+    )
+    for file in files:
+        _file_fingerprint(file, digest)
+    return digest.hexdigest()
+
+
+def _evict(directory, max_bytes):
+    entries = sorted(directory.glob("*.arrow"), key=lambda p: p.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        total -= entry.stat().st_size
+        entry.unlink()
+
+
+def cached(version, inputs, name):
+    """
+    Cache the DataFrame returned by the decorated function.
+
+    name identifies the function in the key. It is given explicitly rather than taken from
+    the function's module, which is __main__ when its file is run as a script, so a script
+    and code importing it share entries. inputs names the arguments that are paths to input
+    files, which are keyed on their fingerprint rather than their name. Every other argument
+    is keyed on its repr.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            directory = _settings["directory"]
+            if directory is None:
+                return func(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = {
+                "function": name,
+                "version": version,
+                "arguments": {
+                    name: fingerprint(value) if name in inputs else repr(value)
+                    for name, value in arguments.arguments.items()
+                },
+            }
+            digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode())
+            path = directory / f"{func.__name__}-{digest.hexdigest()[:16]}.arrow"
+
+            if path.exists():
+                # Entries are evicted by modification time, so mark this one as used
+                os.utime(path)
+                return feather.read_feather(path, memory_map=True)
+
+            result = func(*args, **kwargs)
+            directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            feather.write_feather(result, tmp_path, compression="uncompressed")
+            os.replace(tmp_path, path)
+            _evict(directory, _settings["max_bytes"])
+            return result
+
+        return wrapper
+
+    return decorator
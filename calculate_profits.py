@@ -1,14 +1,51 @@
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 import pyarrow as pa
 import pandas as pd
 from tqdm import tqdm
 
+import cache
+from datasets import (
+    existing_columns,
+    hash_partition,
+    is_binary,
+    iter_batches,
+    lookup_codes,
+    read_table,
+    sort_categories,
+    to_dictionary_array,
+)
+from instrumentation import add_arguments, instrument, stage
+from schemas import CATEGORY
+
+PROFITS_SCHEMA = pa.schema(
+    [
+        ("userId", CATEGORY),
+        ("contractId", CATEGORY),
+        ("profit", pa.float64()),
+        ("groupSlugs", pa.list_(pa.string())),
+        ("lastBetTime", pa.int64()),
+        ("resolveTime", pa.int64()),
+    ]
+)
+
 
 def calculate_payout(bet, resolution):
     return bet["shares"] if bet["outcome"] == resolution else 0.0
 
 
 def get_profit_metrics(contract, bets) -> float:
+    """
+    Profit of one user's bets on one contract, looping bet by bet.
+
+    This is the reference for calculate_profits, which computes every group at once.
+    """
     resolution = contract.get("resolution")
     total_invested = 0
     payout = 0.0
@@ -29,82 +66,365 @@ def get_profit_metrics(contract, bets) -> float:
     return payout + sale_value + redeemed - total_invested
 
 
-def main():
-    contracts_path = "manifold_datasets/contracts.parquet"
-    bets_path = "manifold_datasets/bets.parquet"
-    output_path = "manifold_datasets/profits.parquet"
+ACCUMULATOR_KEYS = ["userId", "contractId", "outcome"]
+ACCUMULATOR_AGGREGATIONS = {
+    "invested": "sum",
+    "saleValue": "sum",
+    "redeemed": "sum",
+    "shares": "sum",
+    "lastBetTime": "max",
+}
+ACCUMULATOR_SCHEMA = pa.schema(
+    [
+        ("userId", CATEGORY),
+        ("contractId", CATEGORY),
+        ("outcome", CATEGORY),
+        ("invested", pa.int64()),
+        ("saleValue", pa.int64()),
+        ("redeemed", pa.int64()),
+        ("shares", pa.float64()),
+        ("lastBetTime", pa.int64()),
+    ]
+)
+# Bytes of accumulators to hold in memory before spilling them to disk
+MEMORY_BUDGET = 1 << 30
 
-    print("reading contracts")
-    contracts_df = pd.read_parquet(contracts_path)
-    print("reading bets")
-    bets_df = pd.read_parquet(bets_path)
-    print("done reading data")
 
+def profit_accumulators(bets_df):
+    """
+    Sums of a set of bets per (userId, contractId, outcome) that profits are computed from.
+
+    invested, saleValue and redeemed are the money put in and taken out of the contract, and
+    shares is what the bets pay out if the contract resolves to outcome. Accumulators of
+    disjoint sets of bets can be combined with merge_profit_accumulators.
+    """
+    amount = bets_df["amount"].to_numpy()
+    if "isRedemption" in bets_df:
+        is_redemption = bets_df["isRedemption"].fillna(False).to_numpy(dtype=bool)
+    else:
+        is_redemption = np.zeros(len(bets_df), dtype=bool)
+
+    return (
+        bets_df[ACCUMULATOR_KEYS]
+        .assign(
+            invested=np.where(~is_redemption & (amount > 0), amount, 0),
+            saleValue=np.where(~is_redemption & (amount <= 0), -amount, 0),
+            redeemed=np.where(is_redemption, -amount, 0),
+            shares=bets_df["shares"].to_numpy(dtype=np.float64),
+            lastBetTime=bets_df["createdTime"].to_numpy(),
+        )
+        .groupby(ACCUMULATOR_KEYS, sort=False, observed=True)
+        .agg(ACCUMULATOR_AGGREGATIONS)
+        .reset_index()
+    )
+
+
+def merge_profit_accumulators(accumulators):
+    """
+    Combine a list of accumulator frames into one row per (userId, contractId, outcome).
+    """
+    return (
+        pd.concat(accumulators, ignore_index=True)
+        .groupby(ACCUMULATOR_KEYS, sort=False, observed=True)
+        .agg(ACCUMULATOR_AGGREGATIONS)
+        .reset_index()
+    )
+
+
+def profits_from_accumulators(contracts_df, accumulators):
+    """
+    Profit of every (userId, contractId) pair on a binary contract, from its accumulators.
+
+    Payouts are only settled here, against the current resolution of each contract, so
+    accumulators stay valid when a contract resolves after its bets were accumulated.
+    """
     # Only keep binary contracts
     contracts_df = contracts_df[contracts_df["outcomeType"].str.upper() == "BINARY"]
-    # TODO: is getting single entries really that innefficient that we need to convert to dict?
-    contracts = contracts_df.set_index("id").to_dict(orient="index")
-    valid_contract_ids = set(contracts.keys())
+    contracts_df = contracts_df.drop_duplicates("id", keep="last").reset_index(
+        drop=True
+    )
 
-    # Only keep bets for binary contracts
-    bets_df = bets_df[bets_df["contractId"].isin(valid_contract_ids)]
+    # Only keep accumulators for binary contracts, and attach their contract position
+    contract_positions = lookup_codes(
+        pd.Index(contracts_df["id"]), accumulators["contractId"]
+    )
+    has_contract = contract_positions >= 0
+    accumulators = accumulators[has_contract]
+    contract_positions = contract_positions[has_contract]
 
-    # Group bets by userId and contractId
-    grouped = bets_df.groupby(["userId", "contractId"])
+    resolution = contracts_df["resolution"].to_numpy(dtype=object)[contract_positions]
+    is_payout = accumulators["outcome"].to_numpy(dtype=object) == resolution
 
-    records = []
-    for (userId, contractId), group in tqdm(
-        grouped, total=len(grouped), desc="Calculating profits"
-    ):
-        contract = contracts.get(contractId)
-        if contract is None:
-            continue
+    # Categorical ids group in category order, so sort categories to match string order
+    keys = {
+        key: sort_categories(accumulators[key])
+        for key in ["userId", "contractId"]
+        if isinstance(accumulators[key].dtype, pd.CategoricalDtype)
+    }
+    grouped = (
+        accumulators[["userId", "contractId", "invested", "saleValue", "redeemed"]]
+        .assign(
+            **keys,
+            payout=np.where(is_payout, accumulators["shares"].to_numpy(), 0.0),
+            lastBetTime=accumulators["lastBetTime"].to_numpy(),
+            contractPosition=contract_positions,
+        )
+        .groupby(["userId", "contractId"], sort=True, observed=True)
+        .agg(
+            invested=("invested", "sum"),
+            saleValue=("saleValue", "sum"),
+            redeemed=("redeemed", "sum"),
+            payout=("payout", "sum"),
+            lastBetTime=("lastBetTime", "max"),
+            contractPosition=("contractPosition", "first"),
+        )
+        .reset_index()
+    )
+    positions = grouped["contractPosition"].to_numpy()
 
-        bets = group.to_dict(orient="records")
-        profit = get_profit_metrics(contract, bets)
+    group_slugs = pa.array(contracts_df["groupSlugs"], type=pa.list_(pa.string()))
+    group_slugs = pc.fill_null(group_slugs, pa.scalar([], type=group_slugs.type))
 
-        groupSlugs = contract.get("groupSlugs", [])
-        if not isinstance(groupSlugs, list):
-            groupSlugs = []
+    resolution_time = contracts_df["resolutionTime"]
+    is_resolved = contracts_df["isResolved"].fillna(False).astype(bool) & (
+        resolution_time.notna()
+    )
+    resolve_time = np.where(is_resolved, resolution_time.fillna(-1), -1).astype(
+        np.int64
+    )
 
-        lastBetTime = int(group["createdTime"].max())
+    return pa.table(
+        {
+            "userId": to_dictionary_array(grouped["userId"]),
+            "contractId": to_dictionary_array(grouped["contractId"]),
+            "profit": (
+                grouped["payout"]
+                + grouped["saleValue"]
+                + grouped["redeemed"]
+                - grouped["invested"]
+            ).to_numpy(dtype=np.float64),
+            "groupSlugs": group_slugs.take(positions),
+            "lastBetTime": grouped["lastBetTime"].to_numpy(dtype=np.int64),
+            "resolveTime": resolve_time[positions],
+        },
+        schema=PROFITS_SCHEMA,
+    )
 
-        if (
-            contract.get("isResolved", False)
-            and contract.get("resolutionTime") is not None
-        ):
-            resolveTime = int(contract["resolutionTime"])
-        else:
-            resolveTime = -1
-
-        records.append(
-            {
-                "userId": userId,
-                "contractId": contractId,
-                "profit": profit,
-                "groupSlugs": groupSlugs,
-                "lastBetTime": lastBetTime,
-                "resolveTime": resolveTime,
-            }
-        )
 
-    # Define schema for output
-    schema = pa.schema(
+def calculate_profits(contracts_df, bets_df):
+    """
+    Calculate the profit of every (userId, contractId) pair on a binary contract.
+
+    Equivalent to calling get_profit_metrics on each group of bets, but each bet is classified
+    as a redemption, investment or sale with array expressions, the bets are reduced to
+    accumulators per outcome, and the payout is settled once per outcome.
+    """
+    return profits_from_accumulators(contracts_df, profit_accumulators(bets_df))
+
+
+def _accumulator_table(accumulators):
+    return pa.table(
+        {
+            **{key: to_dictionary_array(accumulators[key]) for key in ACCUMULATOR_KEYS},
+            **{
+                column: accumulators[column].to_numpy()
+                for column in ACCUMULATOR_AGGREGATIONS
+            },
+        },
+        schema=ACCUMULATOR_SCHEMA,
+    )
+
+
+def iter_profit_accumulators(
+    bets_path,
+    filter=None,
+    memory_budget=MEMORY_BUDGET,
+    num_partitions=64,
+    spill_dir=None,
+):
+    """
+    Accumulators of the bets in bets_path that match filter, read in record batches.
+
+    Batches are folded into in-memory accumulators until those take more than memory_budget
+    bytes. They are then merged, and if that doesn't bring them under half the budget, they
+    are spilled to disk split by a hash of userId. If nothing was spilled this yields all
+    the accumulators at once, otherwise it merges and yields one partition at a time, each
+    holding every accumulator of its users.
+    """
+    columns = existing_columns(
+        bets_path,
         [
-            ("userId", pa.string()),
-            ("contractId", pa.string()),
-            ("profit", pa.float64()),
-            ("groupSlugs", pa.list_(pa.string())),
-            ("lastBetTime", pa.int64()),
-            ("resolveTime", pa.int64()),
+            "userId",
+            "contractId",
+            "amount",
+            "outcome",
+            "shares",
+            "createdTime",
+            "isRedemption",
+        ],
+    )
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        spill_paths = [
+            Path(tmp_dir) / f"spill-{i:03d}.parquet" for i in range(num_partitions)
         ]
+        writers = {}
+        partials = []
+        size = 0
+        try:
+            for batch in tqdm(
+                iter_batches(bets_path, columns=columns, filter=filter),
+                desc="Accumulating bets",
+            ):
+                partials.append(profit_accumulators(batch.to_pandas()))
+                size += partials[-1].memory_usage(deep=True).sum()
+                if size <= memory_budget:
+                    continue
+
+                partials = [merge_profit_accumulators(partials)]
+                size = partials[0].memory_usage(deep=True).sum()
+                if size <= memory_budget / 2:
+                    continue
+
+                table = _accumulator_table(partials[0])
+                partitions = hash_partition(table.column("userId"), num_partitions)
+                for i in np.unique(partitions):
+                    if i not in writers:
+                        writers[i] = pq.ParquetWriter(
+                            spill_paths[i], ACCUMULATOR_SCHEMA
+                        )
+                    writers[i].write_table(table.filter(partitions == i))
+                partials = []
+                size = 0
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        if not writers:
+            if partials:
+                yield merge_profit_accumulators(partials)
+            return
+
+        leftovers = [
+            (partial, hash_partition(partial["userId"], num_partitions))
+            for partial in partials
+        ]
+        for i in tqdm(range(num_partitions), desc="Merging partitions"):
+            parts = [partial[partition == i] for partial, partition in leftovers]
+            if i in writers:
+                parts.append(read_table(spill_paths[i]))
+            parts = [part for part in parts if len(part)]
+            if parts:
+                yield merge_profit_accumulators(parts)
+
+
+@cache.cached(
+    version=1,
+    inputs=["contracts_path"],
+    name="calculate_profits.load_binary_contracts",
+)
+def load_binary_contracts(contracts_path):
+    """
+    The columns of binary contracts that profits are calculated from.
+    """
+    return read_table(
+        contracts_path,
+        columns=[
+            "id",
+            "outcomeType",
+            "groupSlugs",
+            "isResolved",
+            "resolution",
+            "resolutionTime",
+        ],
+        filter=is_binary(ds.field("outcomeType")),
     )
 
-    # Convert to pyarrow Table and write
-    table = pa.Table.from_pylist(records, schema=schema)
-    pq.write_table(table, output_path)
-    print(f"Wrote {len(records)} records to {output_path}")
+
+def main(bets_path="manifold_datasets/bets.parquet", memory_budget=None):
+    contracts_path = "manifold_datasets/contracts.parquet"
+    output_path = "manifold_datasets/profits.parquet"
+
+    print("reading contracts")
+    with stage("read_contracts", read_paths=[contracts_path]) as record:
+        contracts_df = load_binary_contracts(contracts_path)
+        record.rows = len(contracts_df)
+    bets_filter = ds.field("contractId").isin(contracts_df["id"].to_numpy())
+
+    if memory_budget is not None:
+        # Rows come out sorted within each partition of users rather than overall
+        with (
+            stage(
+                "stream_profits", read_paths=[bets_path], write_paths=[output_path]
+            ) as record,
+            pq.ParquetWriter(output_path, PROFITS_SCHEMA) as writer,
+        ):
+            for accumulators in iter_profit_accumulators(
+                bets_path,
+                filter=bets_filter,
+                memory_budget=memory_budget,
+                spill_dir=Path(output_path).parent,
+            ):
+                table = profits_from_accumulators(contracts_df, accumulators)
+                writer.write_table(table)
+                record.rows += len(table)
+        print(f"Wrote {record.rows} records to {output_path}")
+        return
+
+    print("reading bets")
+    with stage("read_bets", read_paths=[bets_path]) as record:
+        bets_df = read_table(
+            bets_path,
+            columns=existing_columns(
+                bets_path,
+                [
+                    "userId",
+                    "contractId",
+                    "amount",
+                    "outcome",
+                    "shares",
+                    "createdTime",
+                    "isRedemption",
+                ],
+            ),
+            filter=bets_filter,
+        )
+        record.rows = len(bets_df)
+    print("done reading data")
+
+    with stage("calculate_profits") as record:
+        table = calculate_profits(contracts_df, bets_df)
+        record.rows = len(bets_df)
+    with stage("write_profits", write_paths=[output_path]) as record:
+        pq.write_table(table, output_path)
+        record.rows = len(table)
+    print(f"Wrote {len(table)} records to {output_path}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--bets",
+        default="manifold_datasets/bets.parquet",
+        help="bets file, or a directory written by layout_bets.py",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="stream bets instead of loading them all, spilling to disk past this many GB",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recompute intermediate tables instead of reusing them from the cache",
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.no_cache:
+        cache.configure(directory=None)
+    with instrument(args.metrics, args.profile):
+        main(
+            bets_path=args.bets,
+            memory_budget=None
+            if args.memory_budget is None
+            else int(args.memory_budget * 1024**3),
+        )
@@ -2,14 +2,35 @@
 Create per-user metrics for churn analysis.
 """
 
+import argparse
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import timedelta
+from itertools import pairwise
+from pathlib import Path
 
 import numpy as np
 np.seterr(all="raise")
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import feather
 from tqdm import tqdm
 
+import cache
+from churn_features import WINDOWS, calculate_all_metrics
+from datasets import hash_partition, read_table
+from feature_store import FEATURE_STORE_PATH, write_feature_store
+from instrumentation import add_arguments, instrument, stage, timed
 
+SNAPSHOT_DATE = pd.to_datetime("2024-07-06")
+CHECKPOINT_DIR = Path("manifold_datasets/churn_parts")
+
+
+@timed
 def calculate_most_recent_streak(betting_dates):
     """
     Calculate the most recent daily streak.
@@ -34,6 +55,34 @@ def calculate_most_recent_streak(betting_dates):
     return streak_length.total_seconds() // (24 * 3600)
 
 
+def calculate_streak_metrics(betting_dates):
+    """
+    Calculate the longest daily streak and the number of daily streaks.
+
+    Streaks are broken and counted in days like calculate_most_recent_streak. Runs of bets
+    lasting less than a day are not counted as streaks.
+    """
+    betting_dates = sorted(betting_dates)
+
+    streak_lengths = []
+    streak_length = timedelta(days=0)
+    for prev_date, curr_date in pairwise(betting_dates):
+        delta = curr_date - prev_date
+        if delta <= timedelta(days=1):
+            streak_length += delta
+        else:
+            streak_lengths.append(streak_length)
+            streak_length = timedelta(days=0)
+    streak_lengths.append(streak_length)
+
+    days = [length.total_seconds() // (24 * 3600) for length in streak_lengths]
+    return {
+        "longestDailyStreak": max(days),
+        "numDailyStreaks": sum(1 for d in days if d >= 1),
+    }
+
+
+@timed
 def calculate_commment_metrics(comments, user_id, last_bet_time):
     """
     Calculate comment metrics for a user within the last 7 and 30 days from the last bet time.
@@ -55,6 +104,7 @@ def calculate_commment_metrics(comments, user_id, last_bet_time):
     }
 
 
+@timed
 def calculate_contract_metrics(contracts, user_id, last_bet_time):
     """
     Calculate contract creation metrics for a user within the last 7 and 30 days from the last bet time.
@@ -74,6 +124,7 @@ def calculate_contract_metrics(contracts, user_id, last_bet_time):
     }
 
 
+@timed
 def calculate_bet_metrics(user_data, last_bet_time):
     """
     Calculate bet metrics for a user within the last 7 and 30 days from the last bet time.
@@ -135,6 +186,7 @@ def calculate_bet_metrics(user_data, last_bet_time):
     }
 
 
+@timed
 def calculate_market_age_metrics(user_data, contracts, last_bet_time):
     uc = user_data[(user_data["createdTime"] >= last_bet_time - pd.Timedelta(days=7))].merge(contracts, left_on="contractId", right_on="id", how="left", suffixes=("_u", "_c"))
     market_age = uc["createdTime_u"] - uc["createdTime_c"]
@@ -166,79 +218,346 @@ def calculate_market_age_metrics(user_data, contracts, last_bet_time):
     }
 
 
-def main():
-    bets = pd.read_parquet("manifold_datasets/bets.parquet")
-    contracts = pd.read_parquet("manifold_datasets/contracts.parquet")
-    comments = pd.read_parquet("manifold_datasets/comments.parquet")
+def calculate_user_metrics(user_id, user_data, contracts, comments, snapshot_date):
+    """
+    Calculate all churn metrics for a single user, one metric family at a time.
 
-    bets["createdTime"] = pd.to_datetime(bets["createdTime"], unit="ms")
-    contracts["createdTime"] = pd.to_datetime(contracts["createdTime"], unit="ms")
-    comments["createdTime"] = pd.to_datetime(comments["createdTime"], unit="ms")
+    This is the reference for churn_features.calculate_all_metrics, which computes the same row
+    for every user at once.
+    """
+    last_bet_time = user_data["createdTime"].max()
+    days_since_last_bet = (snapshot_date - last_bet_time).days
 
-    bet_times = bets.groupby("userId").agg(
-        firstBetTime=("createdTime", "min"), lastBetTime=("createdTime", "max")
+    contract_metrics = calculate_contract_metrics(
+        contracts=contracts, user_id=user_id, last_bet_time=last_bet_time
     )
-    bet_times = bet_times.assign(
-        daysSinceFirstBet=lambda x: (
-            pd.to_datetime("2024-07-06") - x["firstBetTime"]
-        ).dt.days,
-        daysSinceLastBet=lambda x: (
-            pd.to_datetime("2024-07-06") - x["lastBetTime"]
-        ).dt.days,
-    )
-    valid_user_ids = bet_times[
-        ((bet_times["daysSinceFirstBet"] > 30) & (bet_times["daysSinceLastBet"] < 30))
-        | ((bet_times["daysSinceLastBet"] > 30) & (bet_times["daysSinceLastBet"] < 120))
-    ]
 
-    valid_bets = bets[
-        bets["userId"].isin(valid_user_ids.index)
-        # filter out bets on markets that were filtered out previously
-        # due to being a poll or another weird kind of market type
-        & bets["contractId"].isin(contracts["id"].unique())
-    ]
+    market_age_metrics = calculate_market_age_metrics(
+        user_data=user_data, contracts=contracts, last_bet_time=last_bet_time
+    )
 
+    commment_metrics = calculate_commment_metrics(
+        comments=comments, user_id=user_id, last_bet_time=last_bet_time
+    )
 
-    results = []
+    bet_metrics = calculate_bet_metrics(
+        user_data=user_data, last_bet_time=last_bet_time
+    )
 
-    for user_id, user_data in tqdm(
-        valid_bets.sort_values(["userId", "createdTime"]).groupby("userId")
-    ):
-        last_bet_time = user_data["createdTime"].max()
-        days_since_last_bet = (pd.to_datetime("2024-07-06") - last_bet_time).days
+    streak_metrics = calculate_streak_metrics(user_data["createdTime"])
 
-        contract_metrics = calculate_contract_metrics(
-            contracts=contracts, user_id=user_id, last_bet_time=last_bet_time
-        )
+    return {
+        "userId": user_id,
+        "daysSinceLastBet": days_since_last_bet,
+        **contract_metrics,
+        **commment_metrics,
+        **bet_metrics,
+        **market_age_metrics,
+        **streak_metrics,
+    }
 
-        market_age_metrics = calculate_market_age_metrics(
-            user_data=user_data, contracts=contracts, last_bet_time=last_bet_time
-        )
 
-        commment_metrics = calculate_commment_metrics(
-            comments=comments, user_id=user_id, last_bet_time=last_bet_time
-        )
+def _read_shared(path):
+    """
+    Memory-map a table written by iter_shard_metrics.
+    """
+    with pa.memory_map(str(path)) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def _calculate_shard_metrics(shared_dir, shard, windows):
+    return calculate_all_metrics(
+        bets=_read_shared(Path(shared_dir) / f"bets-{shard}.arrow"),
+        contracts=_read_shared(Path(shared_dir) / "contracts.arrow"),
+        comments=_read_shared(Path(shared_dir) / f"comments-{shard}.arrow"),
+        snapshot_date=SNAPSHOT_DATE,
+        windows=windows,
+    )
 
-        bet_metrics = calculate_bet_metrics(
-            user_data=user_data, last_bet_time=last_bet_time
-        )
 
-        results.append(
-            {
-                "userId": user_id,
-                "daysSinceLastBet": days_since_last_bet,
-                **contract_metrics,
-                **commment_metrics,
-                **bet_metrics,
-                **market_age_metrics,
-            }
+def iter_shard_metrics(
+    bets, contracts, comments, num_shards, workers=1, windows=WINDOWS
+):
+    """
+    Calculate churn metrics one shard of users at a time, yielding each shard's results as
+    soon as it is done.
+
+    Users are hash-partitioned into num_shards shards. With more than one worker, each
+    shard's bets and comments, and the full contracts table, are written once as
+    uncompressed Arrow IPC files that the workers memory-map, so no data is pickled per
+    task. Shards finish in any order, so sort the concatenated results by userId.
+    """
+    bet_shards = bets.groupby(hash_partition(bets["userId"], num_shards))
+    comment_shards = dict(
+        list(comments.groupby(hash_partition(comments["userId"], num_shards)))
+    )
+    no_comments = comments.iloc[:0]
+
+    if workers == 1:
+        for shard, shard_bets in bet_shards:
+            yield calculate_all_metrics(
+                bets=shard_bets,
+                contracts=contracts,
+                comments=comment_shards.get(shard, no_comments),
+                snapshot_date=SNAPSHOT_DATE,
+                windows=windows,
+            )
+        return
+
+    with tempfile.TemporaryDirectory(dir="manifold_datasets") as shared_dir:
+        shared_dir = Path(shared_dir)
+        feather.write_feather(
+            contracts.reset_index(drop=True),
+            shared_dir / "contracts.arrow",
+            compression="uncompressed",
         )
+        for shard, shard_bets in bet_shards:
+            feather.write_feather(
+                shard_bets.reset_index(drop=True),
+                shared_dir / f"bets-{shard}.arrow",
+                compression="uncompressed",
+            )
+            feather.write_feather(
+                comment_shards.get(shard, no_comments).reset_index(drop=True),
+                shared_dir / f"comments-{shard}.arrow",
+                compression="uncompressed",
+            )
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_calculate_shard_metrics, shared_dir, shard, windows)
+                for shard in bet_shards.groups
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+
+
+def _read_manifest(checkpoint_dir):
+    """
+    Entries for every checkpoint part that was completely written.
+    """
+    manifest_path = checkpoint_dir / "manifest.ndjson"
+    if not manifest_path.exists():
+        return []
+    entries = []
+    with open(manifest_path, "r") as f:
+        for line in f:
+            # A crash while appending can leave a partial line behind
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries
+
+
+def write_checkpoint(checkpoint_dir, results):
+    """
+    Write one batch of results as its own part file and record its users in the manifest.
+
+    Parts are written under a temporary name and renamed, and only then appended to the
+    manifest, so a part that is listed in the manifest is always complete.
+    """
+    part = checkpoint_dir / f"part-{len(_read_manifest(checkpoint_dir)):05d}.parquet"
+    tmp_part = part.with_suffix(".tmp")
+    results.to_parquet(tmp_part)
+    os.replace(tmp_part, part)
+
+    with open(checkpoint_dir / "manifest.ndjson", "a+") as f:
+        if f.tell() > 0:
+            f.seek(f.tell() - 1)
+            if f.read(1) != "\n":
+                f.write("\n")
+        f.write(json.dumps({"part": part.name, "userIds": results["userId"].tolist()}))
+        f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def completed_user_ids(checkpoint_dir):
+    return {
+        user_id
+        for entry in _read_manifest(checkpoint_dir)
+        for user_id in entry["userIds"]
+    }
+
+
+def finalize_checkpoints(checkpoint_dir, output_path, empty):
+    """
+    Compact the checkpoint parts into a single file sorted by userId.
+
+    empty is written instead when there are no parts, so the file still has the metric
+    columns when no user had any valid bets.
+    """
+    parts = [
+        pd.read_parquet(checkpoint_dir / entry["part"])
+        for entry in _read_manifest(checkpoint_dir)
+    ]
+    results = pd.concat(parts, ignore_index=True) if parts else empty
+    results = results.sort_values("userId", ignore_index=True)
+    results.to_parquet(output_path)
+    shutil.rmtree(checkpoint_dir)
+    return results
+
+
+@cache.cached(version=1, inputs=["contracts_path"], name="churn.load_contracts")
+def load_contracts(contracts_path):
+    """
+    Ids, creators and creation times of contracts, with the times as datetimes.
+    """
+    contracts = read_table(contracts_path, columns=["id", "creatorId", "createdTime"])
+    contracts["createdTime"] = pd.to_datetime(contracts["createdTime"], unit="ms")
+    return contracts
 
-        if len(results) % 200 == 0:
-            pd.DataFrame(results).to_parquet("manifold_datasets/churn_tmp.parquet")
 
-    pd.DataFrame(results).to_parquet("manifold_datasets/churn_2.parquet")
+@cache.cached(version=1, inputs=["bets_path"], name="churn.load_bet_times")
+def load_bet_times(bets_path):
+    """
+    Time of the first and last bet of every user, indexed by userId.
+    """
+    bets = read_table(bets_path, columns=["userId", "createdTime"])
+    bets["createdTime"] = pd.to_datetime(bets["createdTime"], unit="ms")
+    return bets.groupby("userId", observed=True).agg(
+        firstBetTime=("createdTime", "min"), lastBetTime=("createdTime", "max")
+    )
+
+
+def select_valid_users(bet_times, snapshot_date):
+    """
+    Ids of the users to calculate metrics for, given their first and last bet times.
+
+    Keeps users who have bet for over 30 days and are still active, and users who stopped
+    betting between 30 and 120 days before the snapshot.
+    """
+    bet_times = bet_times.assign(
+        daysSinceFirstBet=lambda x: (snapshot_date - x["firstBetTime"]).dt.days,
+        daysSinceLastBet=lambda x: (snapshot_date - x["lastBetTime"]).dt.days,
+    )
+    return bet_times[
+        ((bet_times["daysSinceFirstBet"] > 30) & (bet_times["daysSinceLastBet"] < 30))
+        | ((bet_times["daysSinceLastBet"] > 30) & (bet_times["daysSinceLastBet"] < 120))
+    ].index.to_numpy()
+
+
+def main(
+    workers=1,
+    num_shards=64,
+    resume=False,
+    bets_path="manifold_datasets/bets.parquet",
+    windows=WINDOWS,
+):
+    contracts_path = "manifold_datasets/contracts.parquet"
+    comments_path = "manifold_datasets/comments.parquet"
+    output_path = "manifold_datasets/churn_2.parquet"
+
+    with stage("read_contracts", read_paths=[contracts_path]) as record:
+        contracts = load_contracts(contracts_path)
+        record.rows = len(contracts)
+
+    with stage("bet_times", read_paths=[bets_path]) as record:
+        bet_times = load_bet_times(bets_path)
+        record.rows = len(bet_times)
+        # Typed, since pyarrow can't infer the type of an empty filter value set
+        valid_user_ids = pa.array(
+            select_valid_users(bet_times, SNAPSHOT_DATE).astype(str), type=pa.string()
+        )
+
+    # Only read bets and comments of valid users, on markets that weren't filtered out
+    # previously due to being a poll or another weird kind of market type
+    with stage("read_valid_bets", read_paths=[bets_path]) as record:
+        valid_bets = read_table(
+            bets_path,
+            columns=["userId", "contractId", "createdTime"],
+            filter=ds.field("userId").isin(valid_user_ids)
+            & ds.field("contractId").isin(contracts["id"].unique()),
+        )
+        valid_bets["createdTime"] = pd.to_datetime(valid_bets["createdTime"], unit="ms")
+        record.rows = len(valid_bets)
+    with stage("read_comments", read_paths=[comments_path]) as record:
+        comments = read_table(
+            comments_path,
+            columns=["userId", "likes", "createdTime"],
+            filter=ds.field("userId").isin(valid_user_ids),
+        )
+        comments["createdTime"] = pd.to_datetime(comments["createdTime"], unit="ms")
+        record.rows = len(comments)
+
+    if resume and CHECKPOINT_DIR.exists():
+        valid_bets = valid_bets[
+            ~valid_bets["userId"].isin(completed_user_ids(CHECKPOINT_DIR))
+        ]
+    else:
+        shutil.rmtree(CHECKPOINT_DIR, ignore_errors=True)
+    CHECKPOINT_DIR.mkdir(parents=True, exist_ok=True)
+
+    # With more than one worker, the per-function timings of the workers aren't recorded
+    with stage("churn_metrics") as record:
+        for results in tqdm(
+            iter_shard_metrics(
+                bets=valid_bets,
+                contracts=contracts,
+                comments=comments,
+                num_shards=num_shards,
+                workers=workers,
+                windows=windows,
+            ),
+            desc="Shards",
+        ):
+            write_checkpoint(CHECKPOINT_DIR, results)
+        record.rows = len(valid_bets)
+
+    with stage("finalize", write_paths=[output_path, FEATURE_STORE_PATH]):
+        empty = calculate_all_metrics(
+            valid_bets.iloc[:0], contracts, comments.iloc[:0], SNAPSHOT_DATE, windows
+        )
+        results = finalize_checkpoints(CHECKPOINT_DIR, output_path, empty)
+        write_feature_store(results, bet_times, SNAPSHOT_DATE)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to split users across",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=64,
+        help="number of user batches, each checkpointed as its own part file",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip users already checkpointed by an interrupted run",
+    )
+    parser.add_argument(
+        "--bets",
+        default="manifold_datasets/bets.parquet",
+        help="bets file, or a directory written by layout_bets.py",
+    )
+    parser.add_argument(
+        "--windows",
+        type=int,
+        nargs="+",
+        default=list(WINDOWS),
+        help="lengths in days of the windows before each user's last bet",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recompute intermediate tables instead of reusing them from the cache",
+    )
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.no_cache:
+        cache.configure(directory=None)
+    with instrument(args.metrics, args.profile):
+        main(
+            workers=args.workers,
+            num_shards=args.shards,
+            resume=args.resume,
+            bets_path=args.bets,
+            windows=args.windows,
+        )
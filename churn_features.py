@@ -0,0 +1,333 @@
+"""
+Columnar versions of the per-user churn metrics in churn.py.
+
+Instead of masking the full bets, contracts and comments frames once per user, every metric is
+computed for all users at once from arrays sorted by (userId, createdTime). Per-user values are
+reduced over group boundaries, and contracts and comments are joined against each user's
+window by mapping their ids onto the same integer user codes.
+"""
+
+import numpy as np
+import pandas as pd
+
+from datasets import lookup_codes, sort_categories
+from instrumentation import timer
+
+DAY_NS = 24 * 3600 * 10**9
+DAY_MS = DAY_NS // 10**6
+WINDOWS = (7, 30)
+
+
+def _to_ns(times):
+    return np.asarray(times, dtype="datetime64[ns]").view("int64")
+
+
+def _group_bounds(codes, num_groups):
+    """
+    Start and end offsets of each group in an array sorted by group code.
+    """
+    counts = np.bincount(codes, minlength=num_groups)
+    ends = np.cumsum(counts)
+    return ends - counts, ends
+
+
+def _factorize_users(user_ids):
+    """
+    Integer codes for user ids, numbered in sorted id order.
+    """
+    if isinstance(user_ids.dtype, pd.CategoricalDtype):
+        user_ids = sort_categories(user_ids)
+        return user_ids.cat.codes.to_numpy(), user_ids.cat.categories
+    return pd.factorize(user_ids, sort=True)
+
+
+def prefix_sum(values):
+    return np.r_[0, np.cumsum(values)]
+
+
+class UserEvents:
+    """
+    Events sorted by (user, time), with keys to binary search for each user's events
+    before a given time.
+
+    A key packs the user code above the event time relative to origin, so one sorted int64
+    array covers every user.
+    """
+
+    def __init__(self, codes, times, origin, shift):
+        order = np.lexsort((times, codes))
+        self.order = order
+        self.codes = codes[order]
+        self.times = times[order]
+        self.origin = origin
+        self.shift = shift
+        self.keys = (self.codes.astype(np.int64) << shift) + (self.times - origin)
+
+    def position(self, users, times):
+        """
+        Index of each user's first event at or after the matching time.
+        """
+        return np.searchsorted(
+            self.keys, (users.astype(np.int64) << self.shift) + (times - self.origin)
+        )
+
+
+def _segment_stats(groups, values, num_groups):
+    """
+    Count, median, sample standard deviation, min and max of values per group, for values
+    already sorted by (group, value).
+
+    The median is exact and min/max are the segment ends. Groups with no values get NaN for
+    every statistic, and groups with one value get a NaN std.
+    """
+    starts, ends = _group_bounds(groups, num_groups)
+    counts = ends - starts
+    has_values = counts > 0
+
+    median = np.full(num_groups, np.nan)
+    minimum = np.full(num_groups, np.nan)
+    maximum = np.full(num_groups, np.nan)
+    std = np.full(num_groups, np.nan)
+
+    lo = starts[has_values] + (counts[has_values] - 1) // 2
+    hi = starts[has_values] + counts[has_values] // 2
+    median[has_values] = (values[lo] + values[hi]) / 2
+    minimum[has_values] = values[starts[has_values]]
+    maximum[has_values] = values[ends[has_values] - 1]
+
+    sums = np.bincount(groups, weights=values, minlength=num_groups)
+    means = np.zeros(num_groups)
+    means[has_values] = sums[has_values] / counts[has_values]
+    squared = np.bincount(
+        groups, weights=(values - means[groups]) ** 2, minlength=num_groups
+    )
+    has_spread = counts > 1
+    std[has_spread] = np.sqrt(squared[has_spread] / (counts[has_spread] - 1))
+
+    return counts, median, std, minimum, maximum
+
+
+def _sorted_group_stats(groups, values, num_groups):
+    """
+    Count, median, sample standard deviation, min and max of values per group.
+    """
+    order = np.lexsort((values, groups))
+    return _segment_stats(groups[order], values[order], num_groups)
+
+
+def _in_longest_window(last_times, windows, groups, times, *columns):
+    """
+    Events that fall in at least one window, which are all that need sorting.
+    """
+    in_window = times >= last_times[groups] - max(windows) * DAY_NS
+    return groups[in_window], times[in_window], *(c[in_window] for c in columns)
+
+
+def windowed_stats(groups, times, values, last_times, windows, num_groups):
+    """
+    Count, median, sample standard deviation, min and max of the values of each group's
+    events in the given number of days up to its last time, for every window.
+
+    Events are sorted by (group, value) once. Masking out the events before a window keeps
+    the rest sorted, so each window only reduces over segment bounds. Returns a dict from
+    window to the statistics, as arrays indexed by group.
+    """
+    groups, times, values = _in_longest_window(
+        last_times, windows, groups, times, values
+    )
+    order = np.lexsort((values, groups))
+    groups = groups[order]
+    times = times[order]
+    values = values[order]
+    stats = {}
+    for window in windows:
+        in_window = times >= last_times[groups] - window * DAY_NS
+        stats[window] = _segment_stats(groups[in_window], values[in_window], num_groups)
+    return stats
+
+
+def windowed_count_stats(groups, keys, times, last_times, windows, num_groups):
+    """
+    Like windowed_stats, for the number of events with each distinct key of a group.
+
+    Events are paired with their key once. In each window, keys without events aren't
+    counted, so the count is the number of distinct keys the group had events for.
+    """
+    groups, times, keys = _in_longest_window(last_times, windows, groups, times, keys)
+    num_keys = int(keys.max(initial=-1)) + 1
+    pairs, pair_codes = np.unique(
+        groups.astype(np.int64) * num_keys + keys, return_inverse=True
+    )
+    pair_groups = pairs // max(num_keys, 1)
+    stats = {}
+    for window in windows:
+        in_window = times >= last_times[groups] - window * DAY_NS
+        counts = np.bincount(pair_codes[in_window], minlength=len(pairs))
+        present = counts > 0
+        stats[window] = _sorted_group_stats(
+            pair_groups[present], counts[present], num_groups
+        )
+    return stats
+
+
+def _ns_to_days(values):
+    """
+    Equivalent of Timedelta.total_seconds() // (24 * 3600) for an array of nanoseconds.
+    """
+    return np.floor_divide(values / 1e9, 24 * 3600)
+
+
+def calculate_all_streaks(times, starts, ends):
+    """
+    Most recent and longest daily streak, and number of daily streaks, for every user.
+
+    times must be sorted within each [start, end) group. A streak is a run of bets with no gap
+    of more than 24 hours, and its length in days is counted like
+    churn.calculate_most_recent_streak. Runs shorter than a day don't count as streaks.
+    """
+    is_start = np.zeros(len(times), dtype=bool)
+    is_start[starts] = True
+    is_run_start = is_start | (np.diff(times, prepend=times[:1]) > DAY_NS)
+    run_starts = np.flatnonzero(is_run_start)
+    # The first bet always starts a run, so rolling marks the last bet of every run
+    run_ends = np.flatnonzero(np.roll(is_run_start, -1))
+    lengths = _ns_to_days((times[run_ends] - times[run_starts]).astype(np.float64))
+
+    first_runs = np.searchsorted(run_starts, starts)
+    last_runs = np.searchsorted(run_starts, ends - 1, side="right") - 1
+    return (
+        lengths[last_runs],
+        np.maximum.reduceat(lengths, first_runs),
+        np.add.reduceat((lengths >= 1).astype(np.int64), first_runs),
+    )
+
+
+def calculate_all_metrics(bets, contracts, comments, snapshot_date, windows=WINDOWS):
+    """
+    Calculate every churn metric for all users in bets at once.
+
+    The result has one row per user, sorted by userId, with the same columns and values as
+    running calculate_contract_metrics, calculate_commment_metrics, calculate_bet_metrics and
+    calculate_market_age_metrics from churn.py for each user. Timestamp columns are expected
+    to already be converted to datetimes, and contract ids to be unique.
+
+    windows are the lengths in days of the windows before the last bet that the windowed
+    metrics are calculated over. Other windows than 7 and 30 add columns named the same way.
+    """
+    codes, user_ids = _factorize_users(bets["userId"])
+    num_users = len(user_ids)
+    bet_times = _to_ns(bets["createdTime"])
+    order = np.lexsort((bet_times, codes))
+    codes = codes[order]
+    bet_times = bet_times[order]
+    starts, ends = _group_bounds(codes, num_users)
+    last_bet_times = bet_times[ends - 1]
+    days = np.floor_divide(bet_times, DAY_NS)
+    is_start = np.zeros(len(bet_times), dtype=bool)
+    is_start[starts] = True
+
+    market_codes = pd.factorize(bets["contractId"])[0][order]
+    contract_codes = lookup_codes(pd.Index(contracts["id"]), bets["contractId"])[order]
+    contract_times = _to_ns(contracts["createdTime"])
+    has_market = contract_codes >= 0
+    market_ages = (bet_times - contract_times[contract_codes]).astype(np.float64)
+
+    comment_codes = lookup_codes(user_ids, comments["userId"])
+    by_user = comment_codes >= 0
+    comment_codes = comment_codes[by_user]
+    comment_times = _to_ns(comments["createdTime"])[by_user]
+    likes = comments["likes"].to_numpy()[by_user]
+
+    creator_codes = lookup_codes(user_ids, contracts["creatorId"])
+    by_user = creator_codes >= 0
+    creator_codes = creator_codes[by_user]
+    creator_times = contract_times[by_user]
+
+    with timer("churn_features.bet_metrics"):
+        market_stats = windowed_count_stats(
+            codes, market_codes, bet_times, last_bet_times, windows, num_users
+        )
+    with timer("churn_features.market_age_metrics"):
+        market_age_stats = windowed_stats(
+            codes[has_market],
+            bet_times[has_market],
+            market_ages[has_market],
+            last_bet_times,
+            windows,
+            num_users,
+        )
+
+    contract_metrics = {}
+    comment_likes = {}
+    comment_counts = {}
+    bet_counts = {}
+    bets_per_market = {}
+    market_age_metrics = {}
+    for window in windows:
+        thresholds = last_bet_times - window * DAY_NS
+
+        with timer("churn_features.contract_metrics"):
+            created = creator_times >= thresholds[creator_codes]
+            contract_metrics[f"numContractsCreatedLast{window}Days"] = np.bincount(
+                creator_codes[created], minlength=num_users
+            )
+
+        with timer("churn_features.comment_metrics"):
+            commented = comment_times >= thresholds[comment_codes]
+            comment_likes[f"numCommentLikesLast{window}Days"] = np.bincount(
+                comment_codes[commented],
+                weights=likes[commented],
+                minlength=num_users,
+            ).astype(np.int64)
+            comment_counts[f"numCommentsLast{window}Days"] = np.bincount(
+                comment_codes[commented], minlength=num_users
+            )
+
+        # The window is a suffix of each user's sorted bets
+        in_window = bet_times >= thresholds[codes]
+
+        with timer("churn_features.bet_metrics"):
+            entered_window = in_window & (is_start | ~np.roll(in_window, 1))
+            new_day = in_window & (entered_window | (days != np.roll(days, 1)))
+            bet_counts[f"bettingDaysLast{window}Days"] = np.bincount(
+                codes[new_day], minlength=num_users
+            )
+            bet_counts[f"numBetsLast{window}Days"] = np.bincount(
+                codes[in_window], minlength=num_users
+            )
+
+            num_markets, median, std, minimum, maximum = market_stats[window]
+            bets_per_market[f"numMarkets{window}Days"] = num_markets
+            bets_per_market[f"medianBetsPerMarket{window}Days"] = median
+            bets_per_market[f"stdBetsPerMarket{window}Days"] = std
+            bets_per_market[f"minBetsPerMarket{window}Days"] = minimum.astype(np.int64)
+            bets_per_market[f"maxBetsPerMarket{window}Days"] = maximum.astype(np.int64)
+
+        _, median, std, minimum, maximum = market_age_stats[window]
+        market_age_metrics[f"medianMarketAgeLast{window}Days"] = _ns_to_days(median)
+        market_age_metrics[f"stdMarketAgeLast{window}Days"] = _ns_to_days(std)
+        market_age_metrics[f"minMarketAgeLast{window}Days"] = _ns_to_days(minimum)
+        market_age_metrics[f"maxMarketAgeLast{window}Days"] = _ns_to_days(maximum)
+
+    with timer("churn_features.bet_metrics"):
+        daily_streak, longest_streak, num_streaks = calculate_all_streaks(
+            bet_times, starts, ends
+        )
+
+    return pd.DataFrame(
+        {
+            "userId": user_ids,
+            "daysSinceLastBet": np.floor_divide(
+                _to_ns([snapshot_date])[0] - last_bet_times, DAY_NS
+            ),
+            **contract_metrics,
+            **comment_likes,
+            **comment_counts,
+            **bet_counts,
+            "dailyStreak": daily_streak,
+            **bets_per_market,
+            **market_age_metrics,
+            "longestDailyStreak": longest_streak,
+            "numDailyStreaks": num_streaks,
+        }
+    )
@@ -1,3 +1,4 @@
+import argparse
 import json
 from pathlib import Path
 
@@ -5,6 +6,8 @@ import json_stream
 import json_stream.dump
 from tqdm import tqdm
 
+from instrumentation import add_arguments, instrument, stage
+
 
 root = Path("manifold_datasets")
 
@@ -13,23 +16,39 @@ def convert_json_to_ndjson(input_filepath: Path, output_filepath: Path):
     """
     Convert a JSON file to NDJSON format.
     """
-    with open(input_filepath, "r") as fi:
-        with open(output_filepath, "w") as fo:
-            for obj in tqdm(json_stream.load(fi)):
-                fo.write(json.dumps(obj, cls=json_stream.dump.JSONStreamEncoder))
-                fo.write("\n")
+    with stage(
+        "convert_json_to_ndjson",
+        read_paths=[input_filepath],
+        write_paths=[output_filepath],
+    ) as record:
+        with open(input_filepath, "r") as fi:
+            with open(output_filepath, "w") as fo:
+                for obj in tqdm(json_stream.load(fi)):
+                    fo.write(json.dumps(obj, cls=json_stream.dump.JSONStreamEncoder))
+                    fo.write("\n")
+                    record.rows += 1
 
 
 if __name__ == "__main__":
     root = Path("manifold_datasets")
-    convert_json_to_ndjson(
-        root / "manifold-comments-20240706.json" / "manifold-comments-20240706hi.json",
-        root / "comments.ndjson",
-    )
-    convert_json_to_ndjson(
-        root / "manifold-dump-bets-04072024.json" / "bets.json", root / "bets.ndjson"
-    )
-    convert_json_to_ndjson(
-        root / "manifold-comments-20240706.json" / "manifold-comments-20240706hi.json",
-        root / "contracts.ndjson",
-    )
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument(args.metrics, args.profile):
+        convert_json_to_ndjson(
+            root
+            / "manifold-comments-20240706.json"
+            / "manifold-comments-20240706hi.json",
+            root / "comments.ndjson",
+        )
+        convert_json_to_ndjson(
+            root / "manifold-dump-bets-04072024.json" / "bets.json",
+            root / "bets.ndjson",
+        )
+        convert_json_to_ndjson(
+            root
+            / "manifold-comments-20240706.json"
+            / "manifold-comments-20240706hi.json",
+            root / "contracts.ndjson",
+        )
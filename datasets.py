@@ -0,0 +1,124 @@
+"""
+Loading the converted Manifold tables for analysis.
+
+Id-like string columns are kept dictionary-encoded from the Parquet files through to pandas
+categoricals, so each distinct id is stored once and joins and group-bys work on integer
+codes.
+
+Tables are read through Arrow datasets, so column selections and filters are pushed into
+the Parquet scan. Row groups whose statistics rule out the filter are skipped, and the rest
+are read in record batches, so rows that are filtered out are never collected.
+"""
+
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from schemas import CATEGORY
+
+CATEGORICAL_COLUMNS = ["userId", "contractId", "creatorId", "outcome", "outcomeType"]
+BATCH_SIZE = 1_000_000
+
+
+def open_dataset(path):
+    """
+    Arrow dataset over a Parquet file, or a directory of them, with id-like columns
+    dictionary-encoded.
+
+    Files written before the converters dictionary-encoded these columns are decoded the
+    same way.
+    """
+    names = ds.dataset(path, format="parquet").schema.names
+    file_format = ds.ParquetFileFormat(
+        read_options=ds.ParquetReadOptions(
+            dictionary_columns=[c for c in CATEGORICAL_COLUMNS if c in names]
+        )
+    )
+    return ds.dataset(path, format=file_format)
+
+
+def iter_batches(path, columns=None, filter=None, batch_size=BATCH_SIZE):
+    """
+    Stream the rows of a table that match filter as record batches.
+    """
+    yield from open_dataset(path).to_batches(
+        columns=columns, filter=filter, batch_size=batch_size
+    )
+
+
+def read_table(path, columns=None, filter=None):
+    """
+    Read the rows of a table that match filter into pandas, with id-like columns as
+    categoricals.
+    """
+    return (
+        open_dataset(path)
+        .to_table(columns=columns, filter=filter, batch_size=BATCH_SIZE)
+        .to_pandas()
+    )
+
+
+def existing_columns(path, columns):
+    """
+    The subset of columns that a table has, for columns added to the converters later.
+    """
+    names = ds.dataset(path, format="parquet").schema.names
+    return [c for c in columns if c in names]
+
+
+def is_binary(outcome_type):
+    """
+    Filter expression matching binary contracts, whatever the case of outcomeType.
+    """
+    return pc.utf8_upper(outcome_type.cast(pa.string())) == "BINARY"
+
+
+def hash_partition(values, num_partitions):
+    """
+    Assign each value to a partition by a stable hash, so a value lands in the same
+    partition in every run and every process.
+    """
+    if isinstance(values, (pa.Array, pa.ChunkedArray)):
+        values = values.to_pandas()
+    codes, uniques = pd.factorize(values)
+    partitions = np.array(
+        [zlib.crc32(str(value).encode()) % num_partitions for value in uniques],
+        dtype=np.int64,
+    )
+    return partitions[codes]
+
+
+def sort_categories(values):
+    """
+    Categorical with its categories in sorted order, so sorting and grouping by it
+    orders rows the same way as the equivalent string column.
+    """
+    values = values.cat.remove_unused_categories()
+    return values.cat.reorder_categories(values.cat.categories.sort_values())
+
+
+def lookup_codes(index, values):
+    """
+    Map values onto positions in index, with -1 for values that aren't in it.
+
+    Categoricals are looked up once per category rather than once per row.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        category_codes = index.get_indexer(values.cat.categories)
+        value_codes = values.cat.codes.to_numpy()
+        return np.where(value_codes >= 0, category_codes[value_codes], -1)
+    return index.get_indexer(values)
+
+
+def to_dictionary_array(values):
+    """
+    Arrow array of CATEGORY type from a string or categorical column.
+    """
+    array = pa.array(values)
+    if not pa.types.is_dictionary(array.type):
+        array = array.dictionary_encode()
+    return array.cast(CATEGORY)
@@ -0,0 +1,62 @@
+"""
+Churn features as an uncompressed Arrow IPC file, for loading into models without pandas.
+
+churn.py and refresh.py write the store next to churn_2.parquet, with each user's first bet
+joined on. The file is memory-mapped on load, so columns are read straight from the page
+cache and only the features asked for are copied into the returned matrix.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+FEATURE_STORE_PATH = Path("manifold_datasets/churn_features.arrow")
+
+
+def write_feature_store(features, bet_times, snapshot_date, path=FEATURE_STORE_PATH):
+    """
+    Write the churn features, joined with each user's first bet time, as an Arrow IPC file.
+    """
+    first_bet_times = (
+        features["userId"]
+        .astype(str)
+        .map(bet_times["firstBetTime"].set_axis(bet_times.index.astype(str)))
+    )
+    features = features.assign(
+        firstBetTime=first_bet_times,
+        daysSinceFirstBet=(snapshot_date - first_bet_times).dt.days,
+    )
+    table = pa.Table.from_pandas(features, preserve_index=False)
+    tmp_path = Path(path).with_suffix(".tmp")
+    with (
+        pa.OSFile(str(tmp_path), "wb") as sink,
+        pa.ipc.new_file(sink, table.schema) as writer,
+    ):
+        writer.write_table(table)
+    tmp_path.replace(path)
+
+
+def open_feature_store(path=FEATURE_STORE_PATH):
+    """
+    The feature store as an Arrow table backed by a memory map of the file.
+    """
+    return pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+
+
+def _column(table, name):
+    if name == "inactive":
+        return _column(table, "daysSinceLastBet") > 30
+    return table.column(name).to_numpy()
+
+
+def load_features(features, label="inactive", path=FEATURE_STORE_PATH):
+    """
+    Matrix with one column per feature in features, and the label vector to predict.
+
+    label is a column of the store, or inactive for whether the user stopped betting for
+    over 30 days, like in predict_churn.ipynb.
+    """
+    table = open_feature_store(path)
+    matrix = np.column_stack([_column(table, name) for name in features])
+    return matrix, _column(table, label)
@@ -0,0 +1,137 @@
+"""
+Timings, throughput and memory use of the pipeline scripts, reported as JSON.
+
+Scripts wrap each stage in `stage`, which records its wall time, rows, bytes read and
+written, and the process's peak RSS so far. Functions decorated with `timed`, and blocks
+wrapped in `timer`, add up their calls and time. Passing --metrics to a script writes all of
+it to a JSON file, and --profile writes a cProfile dump of the whole run, which snakeviz or
+flameprof can show as a flame graph.
+"""
+
+import cProfile
+import json
+import resource
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import wraps
+from pathlib import Path
+
+_stages = []
+_timers = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+
+
+@dataclass
+class Stage:
+    name: str
+    rows: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    seconds: float = 0.0
+    peak_rss_bytes: int = 0
+
+
+def _size(path):
+    path = Path(path)
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+
+def peak_rss():
+    """
+    Peak RSS of this process so far, in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextmanager
+def stage(name, read_paths=(), write_paths=()):
+    """
+    Record a stage of a script. Set rows on the yielded Stage to get its throughput.
+
+    The sizes of read_paths and write_paths are counted as the bytes the stage read and
+    wrote.
+    """
+    record = Stage(name, bytes_read=sum(_size(path) for path in read_paths))
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record.seconds = time.perf_counter() - start
+        record.bytes_written = sum(_size(path) for path in write_paths)
+        record.peak_rss_bytes = peak_rss()
+        _stages.append(record)
+
+
+@contextmanager
+def timer(name):
+    """
+    Add the time spent in a block to the total for name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timers[name]["calls"] += 1
+        _timers[name]["seconds"] += time.perf_counter() - start
+
+
+def timed(func):
+    """
+    Add the time spent in every call of func to the total for its name.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with timer(func.__qualname__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def report():
+    return {
+        "stages": [
+            {
+                "name": s.name,
+                "seconds": s.seconds,
+                "rows": s.rows,
+                "rowsPerSecond": s.rows / s.seconds if s.seconds > 0 else None,
+                "bytesRead": s.bytes_read,
+                "bytesWritten": s.bytes_written,
+                "peakRssBytes": s.peak_rss_bytes,
+            }
+            for s in _stages
+        ],
+        "functions": dict(_timers),
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--metrics", help="write stage and function timings to this JSON file"
+    )
+    parser.add_argument(
+        "--profile", help="write a cProfile dump of the run to this file"
+    )
+
+
+@contextmanager
+def instrument(metrics_path=None, profile_path=None):
+    """
+    Profile the block if profile_path is given, and write the report to metrics_path.
+    """
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        if metrics_path:
+            Path(metrics_path).write_text(json.dumps(report(), indent=2))
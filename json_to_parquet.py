@@ -0,0 +1,92 @@
+"""
+Convert a Manifold JSON dump straight to Parquet, without writing an NDJSON file in between.
+
+Does the work of convert_json_to_ndjson.py and ndjson_to_parquet.py in one pass, with the
+same entity specs from schemas.py as ndjson_to_parquet.py.
+"""
+
+import argparse
+import json
+import re
+
+import pyarrow.parquet as pq
+
+from instrumentation import add_arguments, instrument, stage
+from ndjson_to_parquet import ROW_GROUP_SIZE, write_rows_to_parquet
+from schemas import SCHEMAS
+
+SEPARATORS = re.compile(r"[\s,]*")
+TERMINATOR = re.compile(r"[\s,\]]")
+
+
+def iter_json_array(json_path, chunk_size=1 << 24):
+    """
+    Yield each element of a file holding one top-level JSON array, reading it in chunks.
+
+    Elements are parsed by the C accelerated decoder in the json module, so only the array
+    brackets and separators are handled in Python. Memory is bounded by the chunk size plus
+    the largest element.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path, "r") as f:
+        buffer = f.read(chunk_size)
+        # Leading whitespace can fill whole chunks
+        while buffer and not buffer.strip():
+            buffer = f.read(chunk_size)
+        pos = SEPARATORS.match(buffer).end()
+        if buffer[pos : pos + 1] != "[":
+            raise ValueError(f"{json_path} does not contain a JSON array")
+        pos += 1
+        at_eof = False
+
+        while True:
+            pos = SEPARATORS.match(buffer, pos).end()
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+
+            if pos < len(buffer):
+                try:
+                    obj, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if at_eof:
+                        raise
+                else:
+                    # A value is only complete once the separator after it is read, since
+                    # a number cut off by the chunk still parses, like 1.5 out of 1.5e-7
+                    if TERMINATOR.match(buffer, end) or at_eof:
+                        yield obj
+                        pos = end
+                        continue
+            elif at_eof:
+                raise ValueError(f"{json_path} ends before the JSON array is closed")
+
+            chunk = f.read(chunk_size)
+            at_eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("entity", choices=SCHEMAS)
+    parser.add_argument("json_path")
+    parser.add_argument("parquet_path")
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with (
+        instrument(args.metrics, args.profile),
+        stage(
+            f"json_to_parquet.{args.entity}",
+            read_paths=[args.json_path],
+            write_paths=[args.parquet_path],
+        ) as record,
+    ):
+        write_rows_to_parquet(
+            iter_json_array(args.json_path),
+            args.parquet_path,
+            args.entity,
+            args.row_group_size,
+        )
+        record.rows = pq.read_metadata(args.parquet_path).num_rows
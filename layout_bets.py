@@ -0,0 +1,103 @@
+"""
+Rewrite bets.parquet clustered by user and time, hash-partitioned into several files.
+
+Each output file holds every bet of the users hashed to it, sorted by (userId, createdTime)
+and written with min/max statistics and page indexes. Reads for a set of users or a time
+window can then skip most row groups, and per-user group-bys see each user's bets together.
+Point churn.py or calculate_profits.py at the output directory with --bets.
+"""
+
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+from datasets import hash_partition, iter_batches, open_dataset, sort_categories
+
+ROW_GROUP_SIZE = 128 * 1024
+
+
+def _sort_by_user_and_time(table):
+    users = sort_categories(table.column("userId").to_pandas())
+    order = np.lexsort(
+        (table.column("createdTime").to_numpy(), users.cat.codes.to_numpy())
+    )
+    return table.take(order)
+
+
+def write_bets_layout(
+    bets_path, output_dir, num_partitions=16, row_group_size=ROW_GROUP_SIZE
+):
+    """
+    Write bets into num_partitions files of users, each sorted by userId then createdTime.
+
+    Bets are first streamed into one unsorted spill file per partition, so only a single
+    partition is ever sorted in memory. The files are written to a new directory that then
+    replaces output_dir, so no parts of an earlier layout with more partitions are left to
+    be read along with them.
+    """
+    output_dir = Path(output_dir)
+    new_dir = output_dir.with_suffix(".new")
+    old_dir = output_dir.with_suffix(".old")
+    shutil.rmtree(new_dir, ignore_errors=True)
+    new_dir.mkdir(parents=True)
+    schema = open_dataset(bets_path).schema
+
+    with tempfile.TemporaryDirectory(dir=output_dir.parent) as spill_dir:
+        spill_paths = [
+            Path(spill_dir) / f"spill-{i:03d}.parquet" for i in range(num_partitions)
+        ]
+        writers = {}
+        try:
+            for batch in tqdm(iter_batches(bets_path), desc="Partitioning bets"):
+                partitions = hash_partition(batch.column("userId"), num_partitions)
+                order = np.argsort(partitions, kind="stable")
+                bounds = np.searchsorted(
+                    partitions[order], np.arange(num_partitions + 1)
+                )
+                for i in range(num_partitions):
+                    if bounds[i] == bounds[i + 1]:
+                        continue
+                    if i not in writers:
+                        writers[i] = pq.ParquetWriter(spill_paths[i], schema)
+                    writers[i].write_batch(batch.take(order[bounds[i] : bounds[i + 1]]))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        for i in tqdm(range(num_partitions), desc="Sorting partitions"):
+            if i in writers:
+                table = _sort_by_user_and_time(pq.read_table(spill_paths[i]))
+            else:
+                table = schema.empty_table()
+            pq.write_table(
+                table,
+                new_dir / f"part-{i:03d}.parquet",
+                row_group_size=row_group_size,
+                write_statistics=True,
+                write_page_index=True,
+                sorting_columns=[
+                    pq.SortingColumn(table.schema.get_field_index("userId")),
+                    pq.SortingColumn(table.schema.get_field_index("createdTime")),
+                ],
+            )
+
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if output_dir.exists():
+        output_dir.rename(old_dir)
+    new_dir.rename(output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--bets", default="manifold_datasets/bets.parquet")
+    parser.add_argument("--output", default="manifold_datasets/bets_by_user")
+    parser.add_argument("--partitions", type=int, default=16)
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE)
+    args = parser.parse_args()
+    write_bets_layout(args.bets, args.output, args.partitions, args.row_group_size)
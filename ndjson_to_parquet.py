@@ -1,173 +1,213 @@
 """
-Written by GPT 4.1 and Cline, which is why the table construction logic is so weird.
+Extract the fields we use from the NDJSON dumps into Parquet files.
+
+Originally written by GPT 4.1 and Cline. Rows are streamed into a ParquetWriter one row
+group at a time, so memory use doesn't grow with the size of the dump.
 """
 
+import argparse
 import json
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import pairwise
 
 import pyarrow as pa
 import pyarrow.parquet as pq
 from tqdm import tqdm
 
+from instrumentation import add_arguments, instrument, stage
+from schemas import SCHEMAS
 
-def stream_ndjson_to_parquet_comments(ndjson_path, parquet_path):
-    # TODO: parse the text field, which then becomes the "content" field
-    fields = [
-        ("id", pa.string()),
-        ("userId", pa.string()),
-        ("contractId", pa.string()),
-        ("likes", pa.int64()),
-        ("createdTime", pa.int64()),
-    ]
-    schema = pa.schema(fields)
-    rows = []
-    part_tables = []
-    with open(ndjson_path, "r") as f, tqdm(desc="Comments") as pbar:
-        for line in f:
-            obj = json.loads(line)
-
-            row = [
-                obj["id"],
-                obj["userId"],
-                obj.get("contractId", ""),
-                obj.get("likes", 0),
-                obj["createdTime"],
-            ]
-            rows.append(row)
+ROW_GROUP_SIZE = 100_000
+CHUNK_BYTES = 64 * 1024 * 1024
 
-            if len(rows) >= 10000:
-                table = pa.Table.from_pylist(
-                    [dict(zip([f[0] for f in fields], r)) for r in rows], schema=schema
-                )
-                part_tables.append(table)
-                rows = []
-            pbar.update(1)
 
-    if rows:
-        table = pa.Table.from_pylist(
-            [dict(zip([f[0] for f in fields], r)) for r in rows], schema=schema
-        )
-        part_tables.append(table)
-
-    if part_tables:
-        big_table = pa.concat_tables(part_tables)
-        pq.write_table(big_table, parquet_path)
-
-
-def stream_ndjson_to_parquet_contracts(ndjson_path, parquet_path):
-    fields = [
-        ("id", pa.string()),
-        ("creatorId", pa.string()),
-        ("totalLiquidity", pa.int64()),
-        ("volume", pa.int64()),
-        ("outcomeType", pa.string()),
-        ("groupSlugs", pa.list_(pa.string())),
-        ("isResolved", pa.bool_()),
-        ("resolution", pa.string()),
-        ("createdTime", pa.int64()),
-        ("resolutionTime", pa.int64()),
-        ("closeTime", pa.int64()),
-    ]
-    schema = pa.schema(fields)
+def rows_to_table(rows, schema):
+    """
+    Build a table by transposing rows into one typed Arrow array per column.
+    """
+    if not rows:
+        return schema.empty_table()
+    columns = zip(*rows)
+    return pa.table(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def write_rows_to_parquet(objs, parquet_path, entity, row_group_size=ROW_GROUP_SIZE):
+    """
+    Stream parsed objects into a Parquet file, writing each row group as soon as it fills.
+
+    Objects are turned into rows by the compiled spec of the entity in schemas.py. At most
+    one row group is held in memory, however many objects there are.
+    """
+    schema = SCHEMAS[entity].arrow_schema
+    make_row = SCHEMAS[entity].make_row
     rows = []
-    part_tables = []
-    with open(ndjson_path, "r") as f, tqdm(desc="Contracts") as pbar:
-        for line in f:
-            obj = json.loads(line)
-            if "totalLiquidity" not in obj and obj["outcomeType"] in {
-                "QUADRATIC_FUNDING",
-                "BOUNTIED_QUESTION",
-                "POLL",
-            }:
+    with (
+        pq.ParquetWriter(parquet_path, schema) as writer,
+        tqdm(desc=entity.capitalize()) as pbar,
+    ):
+        for obj in objs:
+            row = make_row(obj)
+            pbar.update(1)
+            if row is None:
                 continue
-            rows.append(
-                [
-                    obj["id"],
-                    obj["creatorId"],
-                    obj["totalLiquidity"],
-                    obj.get("volume", -1),
-                    obj["outcomeType"],
-                    (
-                        obj.get("groupSlugs", [])
-                        if isinstance(obj.get("groupSlugs", []), list)
-                        else []
-                    ),
-                    obj["isResolved"],
-                    obj.get("resolution", ""),
-                    obj["createdTime"],
-                    obj.get("resolutionTime", None),
-                    obj.get("closeTime", None),
-                ]
-            )
-            if len(rows) >= 10000:
-                table = pa.Table.from_pylist(
-                    [dict(zip([f[0] for f in fields], r)) for r in rows], schema=schema
-                )
-                part_tables.append(table)
+            rows.append(row)
+            if len(rows) >= row_group_size:
+                writer.write_table(rows_to_table(rows, schema))
                 rows = []
-            pbar.update(1)
 
-    if rows:
-        table = pa.Table.from_pylist(
-            [dict(zip([f[0] for f in fields], r)) for r in rows], schema=schema
-        )
-        part_tables.append(table)
-
-    if part_tables:
-        big_table = pa.concat_tables(part_tables)
-        pq.write_table(big_table, parquet_path)
-
-
-def stream_ndjson_to_parquet_bets(ndjson_path, parquet_path):
-    fields = [
-        ("userId", pa.string()),
-        ("contractId", pa.string()),
-        ("amount", pa.int64()),
-        ("outcome", pa.string()),
-        ("shares", pa.float64()),
-        ("createdTime", pa.int64()),
-    ]
-    schema = pa.schema(fields)
-    rows = []
-    part_tables = []
-    with open(ndjson_path, "r") as f, tqdm(desc="Bets") as pbar:
+        if rows:
+            writer.write_table(rows_to_table(rows, schema))
+
+
+def iter_ndjson(ndjson_path):
+    with open(ndjson_path, "r") as f:
         for line in f:
-            obj = json.loads(line)
-            row = [
-                obj["userId"],
-                obj["contractId"],
-                obj["amount"],
-                obj["outcome"],
-                float(obj["shares"]),
-                obj["createdTime"],
-            ]
-            rows.append(row)
+            yield json.loads(line)
+
+
+def split_ndjson(ndjson_path, chunk_bytes=CHUNK_BYTES):
+    """
+    Byte offsets that split an NDJSON file into chunks of whole lines.
+    """
+    size = os.path.getsize(ndjson_path)
+    if size == 0:
+        return [0]
+    offsets = [0]
+    with (
+        open(ndjson_path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+    ):
+        while offsets[-1] + chunk_bytes < size:
+            newline = mm.find(b"\n", offsets[-1] + chunk_bytes)
+            if newline == -1:
+                break
+            offsets.append(newline + 1)
+    if offsets[-1] < size:
+        offsets.append(size)
+    return offsets
+
+
+def _parse_chunk(ndjson_path, entity, start, end):
+    make_row = SCHEMAS[entity].make_row
+    with (
+        open(ndjson_path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+    ):
+        rows = [make_row(json.loads(line)) for line in mm[start:end].splitlines()]
+    return rows_to_table(
+        [row for row in rows if row is not None], SCHEMAS[entity].arrow_schema
+    )
 
-            if len(rows) >= 10000:
-                table = pa.Table.from_pylist(
-                    [dict(zip([f[0] for f in fields], r)) for r in rows], schema=schema
+
+def parallel_ndjson_to_parquet(
+    ndjson_path,
+    parquet_path,
+    entity,
+    workers,
+    chunk_bytes=CHUNK_BYTES,
+    row_group_size=ROW_GROUP_SIZE,
+):
+    """
+    Convert an NDJSON file by parsing newline-aligned chunks of it in a pool of processes.
+
+    Each worker memory-maps the file and turns its chunk into an Arrow table with the
+    entity's spec from schemas.py, like the single process converters. Tables are written in file
+    order, so the output is identical to stream_ndjson_to_parquet_*. At most two chunks per
+    worker are parsed ahead of the writer, so memory stays flat when parsing outpaces it.
+    """
+    offsets = split_ndjson(ndjson_path, chunk_bytes)
+    with (
+        ProcessPoolExecutor(max_workers=workers) as pool,
+        pq.ParquetWriter(parquet_path, SCHEMAS[entity].arrow_schema) as writer,
+        tqdm(desc=entity.capitalize(), total=len(offsets) - 1, unit="chunk") as pbar,
+    ):
+        pending = deque()
+        for start, end in pairwise(offsets):
+            pending.append(pool.submit(_parse_chunk, ndjson_path, entity, start, end))
+            # Write the oldest chunk before submitting more once the window is full
+            if len(pending) == 2 * workers:
+                writer.write_table(
+                    pending.popleft().result(), row_group_size=row_group_size
                 )
-                part_tables.append(table)
-                rows = []
+                pbar.update(1)
+        while pending:
+            writer.write_table(
+                pending.popleft().result(), row_group_size=row_group_size
+            )
             pbar.update(1)
 
-    if rows:
-        table = pa.Table.from_pylist(
-            [dict(zip([f[0] for f in fields], r)) for r in rows], schema=schema
-        )
-        part_tables.append(table)
 
-    if part_tables:
-        big_table = pa.concat_tables(part_tables)
-        pq.write_table(big_table, parquet_path)
+def convert_ndjson(
+    ndjson_path, parquet_path, entity, row_group_size=ROW_GROUP_SIZE, workers=1
+):
+    with stage(
+        f"ndjson_to_parquet.{entity}",
+        read_paths=[ndjson_path],
+        write_paths=[parquet_path],
+    ) as record:
+        if workers > 1:
+            parallel_ndjson_to_parquet(
+                ndjson_path,
+                parquet_path,
+                entity,
+                workers,
+                row_group_size=row_group_size,
+            )
+        else:
+            write_rows_to_parquet(
+                iter_ndjson(ndjson_path), parquet_path, entity, row_group_size
+            )
+        record.rows = pq.read_metadata(parquet_path).num_rows
+
+
+def stream_ndjson_to_parquet_comments(
+    ndjson_path, parquet_path, row_group_size=ROW_GROUP_SIZE, workers=1
+):
+    convert_ndjson(ndjson_path, parquet_path, "comments", row_group_size, workers)
+
+
+def stream_ndjson_to_parquet_contracts(
+    ndjson_path, parquet_path, row_group_size=ROW_GROUP_SIZE, workers=1
+):
+    convert_ndjson(ndjson_path, parquet_path, "contracts", row_group_size, workers)
+
+
+def stream_ndjson_to_parquet_bets(
+    ndjson_path, parquet_path, row_group_size=ROW_GROUP_SIZE, workers=1
+):
+    convert_ndjson(ndjson_path, parquet_path, "bets", row_group_size, workers)
 
 
 if __name__ == "__main__":
-    stream_ndjson_to_parquet_comments(
-        "manifold_datasets/comments.ndjson", "manifold_datasets/comments.parquet"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes parsing chunks of each file",
     )
-    # stream_ndjson_to_parquet_bets(
-    #     "manifold_datasets/bets.ndjson", "manifold_datasets/bets.parquet"
-    # )
-    # stream_ndjson_to_parquet_contracts(
-    #     "manifold_datasets/contracts.ndjson", "manifold_datasets/contracts.parquet"
-    # )
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrument(args.metrics, args.profile):
+        stream_ndjson_to_parquet_comments(
+            "manifold_datasets/comments.ndjson",
+            "manifold_datasets/comments.parquet",
+            workers=args.workers,
+        )
+        # stream_ndjson_to_parquet_bets(
+        #     "manifold_datasets/bets.ndjson",
+        #     "manifold_datasets/bets.parquet",
+        #     workers=args.workers,
+        # )
+        # stream_ndjson_to_parquet_contracts(
+        #     "manifold_datasets/contracts.ndjson",
+        #     "manifold_datasets/contracts.parquet",
+        #     workers=args.workers,
+        # )
@@ -0,0 +1,123 @@
+"""
+Per-user features of how the markets they bet on resolved.
+
+Each row of profits.parquet with a resolveTime is a resolution event for a user: a win if
+they made a profit on the market, a loss if they lost, or N/A if the market resolved
+CANCEL. Events are sorted by (user, resolve time) once, and the events resolved in the 7
+and 30 days up to each user's last bet are found with two binary searches per user. Like
+churn.py, the last bet is the last one on a market in contracts.parquet.
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+import cache
+from calculate_profits import load_binary_contracts
+from churn_features import DAY_MS, WINDOWS, UserEvents, prefix_sum
+from datasets import lookup_codes, read_table
+
+
+def calculate_outcome_metrics(profits, contracts, last_bet_times):
+    """
+    Wins, losses, N/A resolutions and realized profit in each window for every user in
+    last_bet_times, a Series of epoch milliseconds indexed by userId.
+
+    profits has userId, contractId, profit and resolveTime as written by
+    calculate_profits.py, and contracts has the id and resolution of each contract.
+    """
+    user_ids = pd.Index(np.asarray(last_bet_times.index, dtype=object))
+    num_users = len(user_ids)
+    last_bet_times = last_bet_times.to_numpy(dtype=np.int64)
+
+    codes = lookup_codes(user_ids, profits["userId"])
+    contract_positions = lookup_codes(pd.Index(contracts["id"]), profits["contractId"])
+    resolve_times = profits["resolveTime"].to_numpy(dtype=np.int64)
+    is_event = (codes >= 0) & (contract_positions >= 0) & (resolve_times >= 0)
+    codes = codes[is_event]
+    resolve_times = resolve_times[is_event]
+    profit = profits["profit"].to_numpy(dtype=np.float64)[is_event]
+    resolution = contracts["resolution"].to_numpy(dtype=object)[
+        contract_positions[is_event]
+    ]
+
+    all_times = [a for a in [resolve_times, last_bet_times] if len(a)]
+    origin = min(a.min() for a in all_times) - max(WINDOWS) * DAY_MS
+    span = max(a.max() for a in all_times) - origin + 2
+    shift = int(span).bit_length()
+    if num_users.bit_length() + shift > 62:
+        raise ValueError("too many users to pack with their resolve times")
+    events = UserEvents(codes, resolve_times, origin, shift)
+
+    is_cancel = (resolution == "CANCEL")[events.order]
+    profit = profit[events.order]
+    wins = prefix_sum(~is_cancel & (profit > 0))
+    losses = prefix_sum(~is_cancel & (profit < 0))
+    cancels = prefix_sum(is_cancel)
+    realized = prefix_sum(np.where(is_cancel, 0.0, profit))
+
+    users = np.arange(num_users)
+    # Markets that resolved at the time of the last bet count towards the window
+    ends = events.position(users, last_bet_times + 1)
+    counts = {}
+    realized_profit = {}
+    for window in WINDOWS:
+        starts = events.position(users, last_bet_times - window * DAY_MS)
+        counts[f"numWinsLast{window}Days"] = wins[ends] - wins[starts]
+        counts[f"numLossesLast{window}Days"] = losses[ends] - losses[starts]
+        counts[f"numCancelledLast{window}Days"] = cancels[ends] - cancels[starts]
+        realized_profit[f"realizedProfitLast{window}Days"] = (
+            realized[ends] - realized[starts]
+        )
+
+    return pd.DataFrame({"userId": user_ids, **counts, **realized_profit}).sort_values(
+        "userId", ignore_index=True
+    )
+
+
+def main(
+    bets_path="manifold_datasets/bets.parquet",
+    churn_path="manifold_datasets/churn_2.parquet",
+    output_path="manifold_datasets/outcomes.parquet",
+):
+    user_ids = pd.read_parquet(churn_path, columns=["userId"])["userId"].unique()
+    market_ids = read_table("manifold_datasets/contracts.parquet", columns=["id"])["id"]
+    # The same bets as churn.py, so windows end at the same last bet
+    bets = read_table(
+        bets_path,
+        columns=["userId", "createdTime"],
+        filter=ds.field("userId").isin(np.asarray(user_ids, dtype=object))
+        & ds.field("contractId").isin(market_ids.unique()),
+    )
+    last_bet_times = bets.groupby("userId", observed=True)["createdTime"].max()
+    last_bet_times.index = last_bet_times.index.astype(str)
+    contracts = load_binary_contracts("manifold_datasets/contracts.parquet")
+    profits = read_table(
+        "manifold_datasets/profits.parquet",
+        columns=["userId", "contractId", "profit", "resolveTime"],
+        filter=(ds.field("resolveTime") >= 0)
+        & ds.field("userId").isin(last_bet_times.index.to_numpy()),
+    )
+    metrics = calculate_outcome_metrics(profits, contracts, last_bet_times)
+    metrics.to_parquet(output_path)
+    print(f"Wrote {len(metrics)} records to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--bets",
+        default="manifold_datasets/bets.parquet",
+        help="bets file, or a directory written by layout_bets.py",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recompute intermediate tables instead of reusing them from the cache",
+    )
+    args = parser.parse_args()
+    if args.no_cache:
+        cache.configure(directory=None)
+    main(bets_path=args.bets)
@@ -0,0 +1,406 @@
+"""
+Update profits.parquet, churn_2.parquet and the churn feature store from a new Manifold dump
+without recomputing all history.
+
+Bets never change once placed, so the state directory keeps everything the outputs need
+from the bets already seen: profit accumulators per (user, contract, outcome), each user's
+first and last bet time, their current daily streak and the longest and number of their
+earlier ones, and their bets in the 30 days before their last bet. Each refresh only reads
+bets from the stored high-water mark on, folds the ones it hasn't seen into that state,
+and rebuilds the outputs from it.
+
+Contracts and comments are reread from the new dump, since resolutions and likes change
+after the fact. Comments are only read over the 30 day windows of the users being output.
+"""
+
+import argparse
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from calculate_profits import (
+    merge_profit_accumulators,
+    profit_accumulators,
+    profits_from_accumulators,
+)
+from churn import SNAPSHOT_DATE, select_valid_users
+from churn_features import DAY_MS, calculate_all_metrics
+from datasets import existing_columns, lookup_codes, read_table
+from feature_store import FEATURE_STORE_PATH, write_feature_store
+
+STATE_DIR = Path("manifold_datasets/refresh_state")
+WINDOW_MS = 30 * DAY_MS
+STATE_TABLES = ["accumulators", "bet_times", "streaks", "recent_bets", "mark_bets"]
+
+
+def _empty_state():
+    return {
+        "mark": -1,
+        "accumulators": None,
+        "bet_times": pd.DataFrame(
+            {"firstBetTime": [], "lastBetTime": []},
+            index=pd.Index([], dtype=object, name="userId"),
+            dtype=np.int64,
+        ),
+        "streaks": pd.DataFrame(
+            {
+                "lastBetTime": [],
+                "streakStart": [],
+                "longestStreak": [],
+                "numStreaks": [],
+            },
+            index=pd.Index([], dtype=object, name="userId"),
+            dtype=np.int64,
+        ),
+        "recent_bets": None,
+        "mark_bets": None,
+    }
+
+
+def load_state(state_dir):
+    """
+    State left by the previous refresh, or an empty state if there wasn't one.
+
+    A refresh interrupted while swapping in its new state leaves the previous state in
+    state_dir.old, which is used instead.
+    """
+    state_dir = Path(state_dir)
+    if not state_dir.exists() and state_dir.with_suffix(".old").exists():
+        state_dir = state_dir.with_suffix(".old")
+    if not (state_dir / "mark.json").exists():
+        return _empty_state()
+
+    if not all((state_dir / f"{name}.parquet").exists() for name in STATE_TABLES):
+        raise ValueError(
+            f"{state_dir} was written by an older version of refresh.py, delete it to "
+            "rebuild the state from every bet"
+        )
+    state = {"mark": json.loads((state_dir / "mark.json").read_text())["bets"]}
+    for name in STATE_TABLES:
+        state[name] = read_table(state_dir / f"{name}.parquet")
+    for name in ["bet_times", "streaks"]:
+        state[name] = (
+            state[name]
+            .set_index(state[name]["userId"].astype(str).rename("userId"))
+            .drop(columns="userId")
+        )
+    if "longestStreak" not in state["streaks"]:
+        raise ValueError(
+            f"{state_dir} was written before streak counts were kept, delete it to "
+            "rebuild the state from every bet"
+        )
+    return state
+
+
+def save_state(state_dir, state):
+    """
+    Write the state to a new directory and swap it in, so an interrupted refresh leaves
+    the previous state intact rather than a mix of old and new tables.
+    """
+    state_dir = Path(state_dir)
+    new_dir = state_dir.with_suffix(".new")
+    old_dir = state_dir.with_suffix(".old")
+    shutil.rmtree(new_dir, ignore_errors=True)
+    new_dir.mkdir(parents=True)
+    for name in STATE_TABLES:
+        table = state[name]
+        if name in ["bet_times", "streaks"]:
+            table = table.reset_index()
+        table.to_parquet(new_dir / f"{name}.parquet", index=False)
+    (new_dir / "mark.json").write_text(json.dumps({"bets": int(state["mark"])}))
+
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if state_dir.exists():
+        state_dir.rename(old_dir)
+    new_dir.rename(state_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _row_keys(bets, columns):
+    keys = bets[columns].astype(str).agg("\x1f".join, axis=1)
+    # Number identical bets, so each one is matched at most once
+    return list(zip(keys, keys.groupby(keys).cumcount()))
+
+
+def drop_seen_bets(new_bets, mark, mark_bets):
+    """
+    new_bets without the bets at the mark that an earlier refresh already folded in.
+
+    A dump can end partway through the millisecond of its last bet, so the next dump can
+    have more bets at the mark. Bets have no id, so they are matched on all of their
+    columns.
+    """
+    at_mark = new_bets["createdTime"].to_numpy() == mark
+    if mark_bets is None or mark_bets.empty or not at_mark.any():
+        return new_bets
+    columns = [c for c in new_bets.columns if c in mark_bets.columns]
+    seen = set(_row_keys(mark_bets, columns))
+    is_new = np.ones(len(new_bets), dtype=bool)
+    is_new[at_mark] = [key not in seen for key in _row_keys(new_bets[at_mark], columns)]
+    return new_bets[is_new]
+
+
+def update_bet_times(bet_times, new_bets):
+    """
+    First and last bet time of every user, over all of their bets.
+    """
+    new_times = (
+        new_bets.assign(userId=new_bets["userId"].astype(str))
+        .groupby("userId")["createdTime"]
+        .agg(["min", "max"])
+    )
+    bet_times = bet_times.reindex(bet_times.index.union(new_times.index))
+    first = bet_times["firstBetTime"].fillna(new_times["min"])
+    return pd.DataFrame(
+        {
+            "firstBetTime": first.astype(np.int64),
+            "lastBetTime": new_times["max"]
+            .reindex(bet_times.index)
+            .fillna(bet_times["lastBetTime"])
+            .astype(np.int64),
+        }
+    )
+
+
+def update_streaks(streaks, new_bets):
+    """
+    Last bet time and start of the most recent daily streak of every user, with the
+    longest of their earlier streaks in milliseconds and how many of them lasted a day.
+
+    new_bets must all be later than the bets streaks was built from. A user's streak
+    restarts at the last of their new bets that comes more than 24 hours after the bet
+    before it, and otherwise carries on from their previous streak.
+    """
+    if new_bets.empty:
+        return streaks
+    new_bets = new_bets.assign(userId=new_bets["userId"].astype(str)).sort_values(
+        ["userId", "createdTime"]
+    )
+    times = new_bets["createdTime"].to_numpy()
+    codes, user_ids = pd.factorize(new_bets["userId"])
+    is_start = np.diff(codes, prepend=-1) != 0
+    starts = np.flatnonzero(is_start)
+    ends = np.r_[starts[1:], len(times)]
+
+    previous = streaks.reindex(user_ids)
+    previous_times = np.r_[np.nan, times[:-1]].astype(np.float64)
+    previous_times[starts] = previous["lastBetTime"].to_numpy(dtype=np.float64)
+    # A user's first bet is always a break, since there is nothing before it
+    is_break = np.isnan(previous_times) | (times - previous_times > DAY_MS)
+
+    # Runs of new bets between breaks, where a user's first run may carry on their
+    # previous streak
+    run_starts = np.flatnonzero(is_start | is_break)
+    run_ends = np.flatnonzero(np.roll(is_start | is_break, -1))
+    run_users = codes[run_starts]
+    previous_starts = previous["streakStart"].fillna(-1).to_numpy(dtype=np.int64)
+    run_start_times = np.where(
+        is_break[run_starts], times[run_starts], previous_starts[run_users]
+    )
+    durations = times[run_ends] - run_start_times
+    # Every run but a user's last has ended, and so has their previous streak if their
+    # first new bet broke it
+    is_last_run = np.roll(is_start[run_starts], -1)
+    ended_users = np.r_[run_users[~is_last_run], np.flatnonzero(is_break[starts])]
+    ended_durations = np.r_[
+        durations[~is_last_run],
+        (previous["lastBetTime"] - previous["streakStart"]).to_numpy(dtype=np.float64)[
+            is_break[starts]
+        ],
+    ]
+    has_ended = ~np.isnan(ended_durations)
+    ended_users = ended_users[has_ended]
+    ended_durations = ended_durations[has_ended].astype(np.int64)
+
+    longest = previous["longestStreak"].fillna(0).to_numpy(dtype=np.int64, copy=True)
+    np.maximum.at(longest, ended_users, ended_durations)
+    num_streaks = previous["numStreaks"].fillna(0).to_numpy(dtype=np.int64, copy=True)
+    num_streaks += np.bincount(
+        ended_users[ended_durations >= DAY_MS], minlength=len(user_ids)
+    )
+
+    updated = pd.DataFrame(
+        {
+            "lastBetTime": times[ends - 1],
+            "streakStart": run_start_times[is_last_run],
+            "longestStreak": longest,
+            "numStreaks": num_streaks,
+        },
+        index=pd.Index(user_ids, name="userId"),
+    )
+    return pd.concat([streaks.drop(updated.index, errors="ignore"), updated])
+
+
+def update_recent_bets(recent_bets, new_bets, streaks):
+    """
+    Bets within 30 days of their user's last bet, which is all churn_features needs.
+    """
+    recent_bets = pd.concat(
+        [b for b in [recent_bets, new_bets] if b is not None], ignore_index=True
+    )
+    positions = lookup_codes(streaks.index, recent_bets["userId"].astype(str))
+    thresholds = streaks["lastBetTime"].to_numpy()[positions] - WINDOW_MS
+    return recent_bets[recent_bets["createdTime"].to_numpy() >= thresholds].reset_index(
+        drop=True
+    )
+
+
+def _ms_to_days(values):
+    return np.floor_divide((values * 10**6).astype(np.float64) / 1e9, 24 * 3600)
+
+
+def calculate_churn_metrics(state, contracts, comments_path, snapshot_date):
+    """
+    Churn metrics from the refreshed state, with the same rows and values as churn.main.
+    """
+    bet_times = state["bet_times"].apply(pd.to_datetime, unit="ms")
+    valid_user_ids = select_valid_users(bet_times, snapshot_date).astype(str)
+
+    bets = state["recent_bets"]
+    bets = bets[bets["userId"].astype(str).isin(valid_user_ids)].copy()
+    bets["createdTime"] = pd.to_datetime(bets["createdTime"], unit="ms")
+
+    # Only comments within the window of some valid user can be counted
+    last_bet_times = state["streaks"]["lastBetTime"].reindex(valid_user_ids).dropna()
+    window_start = int(last_bet_times.min()) - WINDOW_MS if len(last_bet_times) else 0
+    comments = read_table(
+        comments_path,
+        columns=["userId", "likes", "createdTime"],
+        filter=ds.field("userId").isin(valid_user_ids)
+        & (ds.field("createdTime") >= window_start),
+    )
+    comments["createdTime"] = pd.to_datetime(comments["createdTime"], unit="ms")
+
+    contracts = contracts[["id", "creatorId", "createdTime"]].copy()
+    contracts["createdTime"] = pd.to_datetime(contracts["createdTime"], unit="ms")
+
+    metrics = calculate_all_metrics(bets, contracts, comments, snapshot_date)
+    # The stored streaks cover bets that have since dropped out of the recent bets
+    streaks = state["streaks"].reindex(metrics["userId"].astype(str))
+    current = (streaks["lastBetTime"] - streaks["streakStart"]).to_numpy(dtype=np.int64)
+    metrics["dailyStreak"] = _ms_to_days(current)
+    metrics["longestDailyStreak"] = _ms_to_days(
+        np.maximum(current, streaks["longestStreak"].to_numpy(dtype=np.int64))
+    )
+    metrics["numDailyStreaks"] = streaks["numStreaks"].to_numpy(dtype=np.int64) + (
+        current >= DAY_MS
+    )
+    return metrics
+
+
+def refresh(
+    state_dir=STATE_DIR,
+    bets_path="manifold_datasets/bets.parquet",
+    contracts_path="manifold_datasets/contracts.parquet",
+    comments_path="manifold_datasets/comments.parquet",
+    profits_path="manifold_datasets/profits.parquet",
+    churn_path="manifold_datasets/churn_2.parquet",
+    snapshot_date=SNAPSHOT_DATE,
+    feature_store_path=FEATURE_STORE_PATH,
+):
+    """
+    Fold the bets of a new dump that the state hasn't seen into it, then rewrite the
+    profits and churn tables and the feature store from it.
+
+    Dumps are assumed to only ever add bets at or after the last bet in the previous dump,
+    and a contract to appear no later than its first bet. Bets are never edited or deleted.
+    """
+    state = load_state(state_dir)
+    contracts = read_table(
+        contracts_path,
+        columns=[
+            "id",
+            "creatorId",
+            "createdTime",
+            "outcomeType",
+            "groupSlugs",
+            "isResolved",
+            "resolution",
+            "resolutionTime",
+        ],
+    )
+
+    new_bets = read_table(
+        bets_path,
+        columns=existing_columns(
+            bets_path,
+            [
+                "userId",
+                "contractId",
+                "amount",
+                "outcome",
+                "shares",
+                "createdTime",
+                "isRedemption",
+            ],
+        ),
+        filter=ds.field("createdTime") >= state["mark"],
+    )
+    new_bets = drop_seen_bets(new_bets, state["mark"], state["mark_bets"])
+    print(f"{len(new_bets)} bets since the last refresh")
+
+    is_binary = contracts["outcomeType"].str.upper() == "BINARY"
+    binary_bets = new_bets[new_bets["contractId"].isin(contracts["id"][is_binary])]
+    state["accumulators"] = merge_profit_accumulators(
+        [a for a in [state["accumulators"]] if a is not None]
+        + [profit_accumulators(binary_bets)]
+    )
+
+    # Like churn.main, only bets on markets in contracts.parquet count towards metrics
+    state["bet_times"] = update_bet_times(state["bet_times"], new_bets)
+    market_bets = new_bets.loc[
+        new_bets["contractId"].isin(contracts["id"]),
+        ["userId", "contractId", "createdTime"],
+    ]
+    state["streaks"] = update_streaks(state["streaks"], market_bets)
+    state["recent_bets"] = update_recent_bets(
+        state["recent_bets"], market_bets, state["streaks"]
+    )
+    mark = int(new_bets["createdTime"].to_numpy().max(initial=state["mark"]))
+    mark_bets = new_bets[new_bets["createdTime"] == mark]
+    if mark == state["mark"] and state["mark_bets"] is not None:
+        mark_bets = pd.concat([state["mark_bets"], mark_bets], ignore_index=True)
+    state["mark"] = mark
+    state["mark_bets"] = mark_bets.reset_index(drop=True)
+
+    profits = profits_from_accumulators(contracts, state["accumulators"])
+    pq.write_table(profits, profits_path)
+    print(f"Wrote {len(profits)} records to {profits_path}")
+
+    metrics = calculate_churn_metrics(state, contracts, comments_path, snapshot_date)
+    metrics.to_parquet(churn_path)
+    print(f"Wrote {len(metrics)} records to {churn_path}")
+    write_feature_store(
+        metrics,
+        state["bet_times"].apply(pd.to_datetime, unit="ms"),
+        snapshot_date,
+        feature_store_path,
+    )
+
+    save_state(state_dir, state)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--state", default=str(STATE_DIR))
+    parser.add_argument("--bets", default="manifold_datasets/bets.parquet")
+    parser.add_argument("--contracts", default="manifold_datasets/contracts.parquet")
+    parser.add_argument("--comments", default="manifold_datasets/comments.parquet")
+    parser.add_argument(
+        "--snapshot",
+        default=str(SNAPSHOT_DATE.date()),
+        help="date that daysSinceLastBet and the user filter are measured from",
+    )
+    args = parser.parse_args()
+    refresh(
+        state_dir=args.state,
+        bets_path=args.bets,
+        contracts_path=args.contracts,
+        comments_path=args.comments,
+        snapshot_date=pd.to_datetime(args.snapshot),
+    )
@@ -0,0 +1,193 @@
+"""
+Declarative specs of the fields we extract from each kind of Manifold dump.
+
+Each EntitySchema lists its fields with their Arrow type, default and transform, plus an
+optional row filter. The spec is compiled once into a plain Python function that turns a
+parsed dump object into a row, so adding an entity or a field doesn't need another
+hand-written loop.
+"""
+
+from collections.abc import Callable
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any
+
+import pyarrow as pa
+
+# Marks a field whose key must be present in every object
+REQUIRED = object()
+
+# Type for id-like and low-cardinality string columns, stored once per distinct value
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+
+@dataclass(frozen=True)
+class Field:
+    name: str
+    type: pa.DataType
+    default: Any = None
+    transform: Callable[[Any], Any] | None = None
+    # Key in the dump object, if it differs from the column name
+    source: str | None = None
+
+
+@dataclass(frozen=True)
+class EntitySchema:
+    name: str
+    fields: list[Field]
+    # Returns True for objects that shouldn't become rows
+    skip: Callable[[dict], bool] | None = None
+
+    @cached_property
+    def arrow_schema(self):
+        return pa.schema([(f.name, f.type) for f in self.fields])
+
+    @cached_property
+    def make_row(self):
+        """
+        Function turning a dump object into a list of values, or None if it is skipped.
+
+        The function is generated as source code with one expression per field, so the per
+        row cost is a handful of dict lookups rather than a loop over the spec.
+        """
+        namespace = {"skip": self.skip}
+        values = []
+        for i, f in enumerate(self.fields):
+            key = repr(f.source or f.name)
+            if f.default is REQUIRED:
+                value = f"obj[{key}]"
+            elif f.default is None:
+                value = f"obj.get({key})"
+            else:
+                namespace[f"default_{i}"] = f.default
+                value = f"obj.get({key}, default_{i})"
+            if f.transform is not None:
+                namespace[f"transform_{i}"] = f.transform
+                value = f"transform_{i}({value})"
+            values.append(value)
+
+        lines = ["def make_row(obj):"]
+        if self.skip is not None:
+            lines.append("    if skip(obj):")
+            lines.append("        return None")
+        lines.append(f"    return [{', '.join(values)}]")
+        # Only names and keys from the specs in this module end up in the source
+        exec("\n".join(lines), namespace)  # noqa: S102
+        return namespace["make_row"]
+
+
+def list_or_empty(value):
+    return value if isinstance(value, list) else []
+
+
+def rich_text_to_plain(content):
+    """
+    Plain text of a comment's rich text document, with one line per block.
+    """
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if "text" in content:
+        return content["text"]
+    children = [rich_text_to_plain(child) for child in content.get("content", [])]
+    separator = "\n" if content.get("type") == "doc" else ""
+    return separator.join(children)
+
+
+def is_unsupported_contract(obj):
+    """
+    Market types without liquidity, which we don't analyse.
+    """
+    return "totalLiquidity" not in obj and obj["outcomeType"] in {
+        "QUADRATIC_FUNDING",
+        "BOUNTIED_QUESTION",
+        "POLL",
+    }
+
+
+COMMENTS = EntitySchema(
+    name="comments",
+    fields=[
+        Field("id", pa.string(), REQUIRED),
+        Field("userId", CATEGORY, REQUIRED),
+        Field("contractId", CATEGORY, ""),
+        Field("likes", pa.int64(), 0),
+        Field("createdTime", pa.int64(), REQUIRED),
+        Field("content", pa.string(), transform=rich_text_to_plain),
+    ],
+)
+
+CONTRACTS = EntitySchema(
+    name="contracts",
+    fields=[
+        Field("id", pa.string(), REQUIRED),
+        Field("creatorId", CATEGORY, REQUIRED),
+        Field("totalLiquidity", pa.int64(), REQUIRED),
+        Field("volume", pa.int64(), -1),
+        Field("outcomeType", CATEGORY, REQUIRED),
+        Field("groupSlugs", pa.list_(pa.string()), [], transform=list_or_empty),
+        Field("isResolved", pa.bool_(), REQUIRED),
+        Field("resolution", pa.string(), ""),
+        Field("createdTime", pa.int64(), REQUIRED),
+        Field("resolutionTime", pa.int64()),
+        Field("closeTime", pa.int64()),
+    ],
+    skip=is_unsupported_contract,
+)
+
+BETS = EntitySchema(
+    name="bets",
+    fields=[
+        Field("userId", CATEGORY, REQUIRED),
+        Field("contractId", CATEGORY, REQUIRED),
+        Field("amount", pa.int64(), REQUIRED),
+        Field("outcome", CATEGORY, REQUIRED),
+        Field("shares", pa.float64(), REQUIRED, transform=float),
+        Field("createdTime", pa.int64(), REQUIRED),
+        Field("isRedemption", pa.bool_(), False),
+    ],
+)
+
+USERS = EntitySchema(
+    name="users",
+    fields=[
+        Field("id", pa.string(), REQUIRED),
+        Field("username", pa.string(), ""),
+        Field("createdTime", pa.int64(), REQUIRED),
+        Field("isBot", pa.bool_(), False),
+    ],
+)
+
+TXNS = EntitySchema(
+    name="txns",
+    fields=[
+        Field("id", pa.string(), REQUIRED),
+        Field("fromId", pa.string(), REQUIRED),
+        Field("fromType", pa.string(), ""),
+        Field("toId", pa.string(), REQUIRED),
+        Field("toType", pa.string(), ""),
+        Field("amount", pa.float64(), REQUIRED, transform=float),
+        Field("token", pa.string(), "M$"),
+        Field("category", pa.string(), ""),
+        Field("createdTime", pa.int64(), REQUIRED),
+    ],
+)
+
+LIQUIDITY = EntitySchema(
+    name="liquidity",
+    fields=[
+        Field("id", pa.string(), REQUIRED),
+        Field("userId", CATEGORY, REQUIRED),
+        Field("contractId", CATEGORY, REQUIRED),
+        Field("amount", pa.float64(), REQUIRED, transform=float),
+        Field("liquidity", pa.float64(), 0.0, transform=float),
+        Field("isAnte", pa.bool_(), False),
+        Field("createdTime", pa.int64(), REQUIRED),
+    ],
+)
+
+SCHEMAS = {
+    schema.name: schema
+    for schema in [COMMENTS, CONTRACTS, BETS, USERS, TXNS, LIQUIDITY]
+}
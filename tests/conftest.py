@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+
+from benchmark import generate
+from datasets import read_table
+
+
+@pytest.fixture(scope="session")
+def synthetic_dir(tmp_path_factory):
+    """
+    Synthetic bets, contracts and comments from benchmark.generate.
+    """
+    data_dir = tmp_path_factory.mktemp("synthetic")
+    generate(data_dir, num_bets=20_000, num_users=200, num_contracts=150)
+    return data_dir
+
+
+@pytest.fixture
+def churn_inputs(synthetic_dir):
+    """
+    Bets, contracts and comments with datetimes, and bets only on known contracts, as
+    churn.main passes them to the metrics.
+    """
+    contracts = read_table(
+        synthetic_dir / "contracts.parquet", columns=["id", "creatorId", "createdTime"]
+    )
+    bets = read_table(
+        synthetic_dir / "bets.parquet", columns=["userId", "contractId", "createdTime"]
+    )
+    comments = read_table(
+        synthetic_dir / "comments.parquet", columns=["userId", "likes", "createdTime"]
+    )
+    for df in [contracts, bets, comments]:
+        df["createdTime"] = pd.to_datetime(df["createdTime"], unit="ms")
+    return bets[bets["contractId"].isin(contracts["id"])], contracts, comments
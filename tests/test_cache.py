@@ -0,0 +1,55 @@
+import importlib.util
+
+import pandas as pd
+import pytest
+
+import cache
+import calculate_profits
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(cache._settings, "directory", tmp_path / "cache")
+    return tmp_path / "cache"
+
+
+def load_as_script(path):
+    """
+    A second copy of a module, under another name, like a file run as a script.
+    """
+    spec = importlib.util.spec_from_file_location("script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_script_and_import_share_entries(synthetic_dir, cache_dir, monkeypatch):
+    contracts_path = synthetic_dir / "contracts.parquet"
+    script = load_as_script(calculate_profits.__file__)
+    expected = script.load_binary_contracts(contracts_path)
+    assert len(list(cache_dir.glob("*.arrow"))) == 1
+
+    # A hit never reads the contracts
+    monkeypatch.setattr(calculate_profits, "read_table", None)
+    result = calculate_profits.load_binary_contracts(str(contracts_path))
+    assert len(list(cache_dir.glob("*.arrow"))) == 1
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_key_changes_with_version(tmp_path, cache_dir):
+    calls = []
+
+    def make(version):
+        @cache.cached(version=version, inputs=["path"], name="test.count")
+        def count(path):
+            calls.append(path)
+            return pd.DataFrame({"x": [len(calls)]})
+
+        return count
+
+    path = tmp_path / "input.txt"
+    path.write_text("data")
+    make(1)(path)
+    make(1)(path)
+    make(2)(path)
+    assert len(calls) == 2
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from calculate_profits import (
+    calculate_profits,
+    get_profit_metrics,
+    iter_profit_accumulators,
+    profits_from_accumulators,
+)
+from datasets import read_table
+
+
+def reference_profits(contracts_df, bets_df):
+    """
+    Profits from get_profit_metrics for each (userId, contractId) group, looping like the
+    original calculate_profits.main.
+    """
+    contracts_df = contracts_df[contracts_df["outcomeType"].str.upper() == "BINARY"]
+    # A contract listed twice in a dump is taken from its last row
+    contracts_df = contracts_df.drop_duplicates("id", keep="last")
+    contracts = contracts_df.set_index("id").to_dict(orient="index")
+    bets_df = bets_df[bets_df["contractId"].isin(set(contracts))]
+    records = []
+    for (user_id, contract_id), group in bets_df.groupby(
+        ["userId", "contractId"], observed=True
+    ):
+        contract = contracts[contract_id]
+        if contract.get("isResolved") and pd.notna(contract.get("resolutionTime")):
+            resolve_time = int(contract["resolutionTime"])
+        else:
+            resolve_time = -1
+        records.append(
+            {
+                "userId": str(user_id),
+                "contractId": str(contract_id),
+                "profit": get_profit_metrics(contract, group.to_dict(orient="records")),
+                "lastBetTime": int(group["createdTime"].max()),
+                "resolveTime": resolve_time,
+            }
+        )
+    return pd.DataFrame(records).sort_values(
+        ["userId", "contractId"], ignore_index=True
+    )
+
+
+def assert_same_profits(contracts_df, bets_df):
+    expected = reference_profits(contracts_df, bets_df)
+    result = calculate_profits(contracts_df, bets_df).to_pandas()
+    result = result.astype({"userId": str, "contractId": str}).sort_values(
+        ["userId", "contractId"], ignore_index=True
+    )
+    pd.testing.assert_frame_equal(
+        result[expected.columns], expected, check_dtype=False, rtol=1e-9
+    )
+
+
+@pytest.fixture
+def edge_cases():
+    contracts = pd.DataFrame(
+        {
+            "id": ["yes", "none", "empty", "multi", "dup", "dup"],
+            "outcomeType": ["BINARY", "binary", "BINARY", "MULTIPLE_CHOICE"]
+            + ["BINARY", "BINARY"],
+            "groupSlugs": [
+                ["a", "b"],
+                None,
+                np.array(["c"], dtype=object),
+                ["d"],
+                [],
+                ["e"],
+            ],
+            "isResolved": [True, False, True, True, True, True],
+            "resolution": ["YES", None, "", "YES", "YES", "NO"],
+            "resolutionTime": [1000, None, 2000, 3000, 4000, 5000],
+        }
+    )
+    rng = np.random.default_rng(0)
+    n = 300
+    bets = pd.DataFrame(
+        {
+            "userId": rng.choice(["u1", "u2", "u3"], n),
+            "contractId": rng.choice(["yes", "none", "empty", "multi", "dup"], n),
+            "amount": rng.choice([-50, -1, 0, 1, 10, 100], n),
+            "outcome": rng.choice(["YES", "NO"], n),
+            "shares": rng.uniform(0, 200, n),
+            "createdTime": rng.integers(0, 10_000, n),
+            "isRedemption": rng.choice(np.array([True, False, None], dtype=object), n),
+        }
+    )
+    return contracts, bets
+
+
+def test_edge_cases_match_reference(edge_cases):
+    assert_same_profits(*edge_cases)
+
+
+def test_synthetic_dumps_match_reference(synthetic_dir):
+    contracts = read_table(synthetic_dir / "contracts.parquet")
+    bets = read_table(synthetic_dir / "bets.parquet")
+    assert_same_profits(contracts, bets)
+
+
+def test_group_slugs_come_from_contracts(edge_cases):
+    # The original loop wrote [] for every contract, because groupSlugs come back from
+    # parquet as arrays rather than lists
+    profits = calculate_profits(*edge_cases).to_pandas()
+    slugs = profits.groupby("contractId", observed=True)["groupSlugs"].first()
+    assert list(slugs["yes"]) == ["a", "b"]
+    assert list(slugs["none"]) == []
+    assert list(slugs["empty"]) == ["c"]
+    assert list(slugs["dup"]) == ["e"]
+    assert "multi" not in slugs.index
+
+
+@pytest.mark.parametrize("memory_budget", [20_000, 10**12])
+def test_streamed_accumulators_match_in_memory(synthetic_dir, tmp_path, memory_budget):
+    contracts = read_table(synthetic_dir / "contracts.parquet")
+    bets = read_table(synthetic_dir / "bets.parquet")
+    # Small row groups give many batches, so the budget is exceeded and rechecked often
+    bets_path = tmp_path / "bets.parquet"
+    pq.write_table(pa.Table.from_pandas(bets), bets_path, row_group_size=1_000)
+
+    parts = [
+        profits_from_accumulators(contracts, accumulators).to_pandas()
+        for accumulators in iter_profit_accumulators(
+            bets_path, memory_budget=memory_budget, num_partitions=8, spill_dir=tmp_path
+        )
+    ]
+    # Only spilled accumulators are merged one partition at a time
+    assert (len(parts) > 1) == (memory_budget < 10**12)
+    assert not list(tmp_path.glob("tmp*"))
+
+    keys = ["userId", "contractId"]
+    result = pd.concat(parts).astype({key: str for key in keys})
+    assert not result.duplicated(keys).any()
+    expected = (
+        calculate_profits(contracts, bets)
+        .to_pandas()
+        .astype({key: str for key in keys})
+    )
+    pd.testing.assert_frame_equal(
+        result.sort_values(keys, ignore_index=True),
+        expected.sort_values(keys, ignore_index=True),
+        check_dtype=False,
+        rtol=1e-9,
+    )
@@ -0,0 +1,31 @@
+import shutil
+
+import pandas as pd
+
+import cache
+import churn
+from datasets import read_table
+
+
+def test_no_valid_users_writes_empty_table(synthetic_dir, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(cache._settings, "directory", None)
+    data_dir = tmp_path / "manifold_datasets"
+    data_dir.mkdir()
+    for name in ["contracts", "comments"]:
+        shutil.copy(synthetic_dir / f"{name}.parquet", data_dir)
+    # Every user stopped betting more than 120 days before the snapshot
+    bets = read_table(synthetic_dir / "bets.parquet")
+    bets["createdTime"] -= (
+        bets["createdTime"].max()
+        - (churn.SNAPSHOT_DATE - pd.Timedelta(days=200)).value // 10**6
+    )
+    bets.to_parquet(data_dir / "bets.parquet")
+
+    churn.main(bets_path=str(data_dir / "bets.parquet"))
+
+    results = pd.read_parquet(data_dir / "churn_2.parquet")
+    assert len(results) == 0
+    assert "userId" in results.columns
+    assert "numBetsLast30Days" in results.columns
+    assert not (data_dir / "churn_parts").exists()
@@ -0,0 +1,98 @@
+import pandas as pd
+import pytest
+
+from churn import SNAPSHOT_DATE, calculate_user_metrics
+from churn_features import calculate_all_metrics
+
+
+def reference_metrics(bets, contracts, comments):
+    """
+    churn.py's per-user metrics for every user in bets, sorted by userId.
+    """
+    return pd.DataFrame(
+        [
+            calculate_user_metrics(
+                user_id, user_data, contracts, comments, SNAPSHOT_DATE
+            )
+            for user_id, user_data in bets.groupby("userId", observed=True)
+        ]
+    )
+
+
+def assert_same_metrics(bets, contracts, comments):
+    expected = reference_metrics(bets, contracts, comments)
+    result = calculate_all_metrics(bets, contracts, comments, SNAPSHOT_DATE)
+    result["userId"] = result["userId"].astype(str)
+    # Categorical ids group in category order rather than string order
+    expected["userId"] = expected["userId"].astype(str)
+    expected = expected.sort_values("userId", ignore_index=True)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+
+
+@pytest.fixture
+def edge_cases():
+    t = pd.Timestamp("2024-06-01")
+    day = pd.Timedelta(days=1)
+    bets = pd.DataFrame(
+        [
+            # A single bet, so every std is NaN
+            ("single", "m1", t),
+            # Bets exactly 7 and 30 days before the last bet are in the windows
+            ("edges", "m1", t - 30 * day),
+            ("edges", "m2", t - 7 * day),
+            ("edges", "m2", t - 7 * day + pd.Timedelta(milliseconds=1)),
+            ("edges", "m3", t),
+            # Just outside both windows, and no comments at all
+            ("quiet", "m1", t - 30 * day - pd.Timedelta(milliseconds=1)),
+            ("quiet", "m2", t - 7 * day - pd.Timedelta(milliseconds=1)),
+            ("quiet", "m2", t),
+            ("quiet", "m3", t),
+        ],
+        columns=["userId", "contractId", "createdTime"],
+    )
+    contracts = pd.DataFrame(
+        [
+            ("m1", "edges", t - 60 * day),
+            ("m2", "single", t - 30 * day),
+            ("m3", "edges", t - 7 * day),
+            # Created after the creator's last bet
+            ("m4", "edges", t + day),
+            ("m5", "quiet", t + 30 * day),
+        ],
+        columns=["id", "creatorId", "createdTime"],
+    )
+    comments = pd.DataFrame(
+        [
+            ("edges", 3, t - 30 * day),
+            ("edges", 1, t - 7 * day),
+            ("edges", 2, t - 7 * day - pd.Timedelta(milliseconds=1)),
+            # Created after the commenter's last bet
+            ("edges", 5, t + day),
+            ("single", 4, t + 2 * day),
+            ("nobody", 1, t),
+        ],
+        columns=["userId", "likes", "createdTime"],
+    )
+    return bets, contracts, comments
+
+
+def test_edge_cases_match_reference(edge_cases):
+    assert_same_metrics(*edge_cases)
+
+
+def test_edge_case_values(edge_cases):
+    result = calculate_all_metrics(*edge_cases, SNAPSHOT_DATE).set_index("userId")
+    assert pd.isna(result.loc["single", "stdBetsPerMarket7Days"])
+    assert pd.isna(result.loc["single", "stdMarketAgeLast30Days"])
+    assert result.loc["edges", "numBetsLast7Days"] == 3
+    assert result.loc["edges", "numBetsLast30Days"] == 4
+    assert result.loc["edges", "numCommentsLast7Days"] == 2
+    assert result.loc["edges", "numCommentLikesLast30Days"] == 11
+    assert result.loc["edges", "numContractsCreatedLast7Days"] == 2
+    assert result.loc["quiet", "numBetsLast7Days"] == 2
+    assert result.loc["quiet", "numBetsLast30Days"] == 3
+    assert result.loc["quiet", "numCommentsLast30Days"] == 0
+
+
+def test_synthetic_dumps_match_reference(churn_inputs):
+    assert_same_metrics(*churn_inputs)
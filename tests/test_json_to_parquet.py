@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+from json_to_parquet import iter_json_array
+
+OBJECTS = [
+    {"id": "a]b", "text": "x, y], [z", "nested": {"list": [1, [2, 3], []]}},
+    123456789,
+    -1.5e-7,
+    'a "quoted" string with \\ and ]',
+    [],
+    {},
+    None,
+    True,
+    {"unicode": "café ☃", "empty": ""},
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 97, 1 << 24])
+@pytest.mark.parametrize("indent", [None, 2])
+def test_elements_match_json_load(tmp_path, chunk_size, indent):
+    path = tmp_path / "dump.json"
+    path.write_text("  \n" + json.dumps(OBJECTS, indent=indent) + "\n")
+    assert list(iter_json_array(path, chunk_size)) == OBJECTS
+
+
+@pytest.mark.parametrize("text", ["[]", "  [ ]  ", "\n[\n]\n"])
+@pytest.mark.parametrize("chunk_size", [1, 97])
+def test_empty_array(tmp_path, text, chunk_size):
+    path = tmp_path / "dump.json"
+    path.write_text(text)
+    assert list(iter_json_array(path, chunk_size)) == []
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        '{"a": 1}',
+        "[1, 2",
+        "[1, 2,",
+        '[{"a": 1}, {"b": "trunc',
+        "[1, 2, 34",
+    ],
+)
+@pytest.mark.parametrize("chunk_size", [1, 3, 97])
+def test_truncated_file_raises(tmp_path, text, chunk_size):
+    path = tmp_path / "dump.json"
+    path.write_text(text)
+    with pytest.raises(ValueError):
+        list(iter_json_array(path, chunk_size))
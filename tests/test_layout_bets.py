@@ -0,0 +1,37 @@
+import pandas as pd
+
+from datasets import read_table
+from layout_bets import write_bets_layout
+
+
+def test_layout_matches_bets(synthetic_dir, tmp_path):
+    bets = read_table(synthetic_dir / "bets.parquet")
+    write_bets_layout(synthetic_dir / "bets.parquet", tmp_path / "layout", 4)
+    result = read_table(tmp_path / "layout")
+    assert len(result) == len(bets)
+    # Each user's bets are in one part, sorted by time
+    assert result.groupby("userId", observed=True)[
+        "createdTime"
+    ].is_monotonic_increasing.all()
+
+
+def test_relayout_with_fewer_partitions_replaces_parts(synthetic_dir, tmp_path):
+    bets_path = synthetic_dir / "bets.parquet"
+    write_bets_layout(bets_path, tmp_path / "layout", 4)
+    write_bets_layout(bets_path, tmp_path / "layout", 2)
+    assert sorted(p.name for p in (tmp_path / "layout").iterdir()) == [
+        "part-000.parquet",
+        "part-001.parquet",
+    ]
+
+    columns = ["userId", "contractId", "createdTime", "amount", "shares"]
+    expected = read_table(bets_path, columns=columns).astype(
+        {"userId": str, "contractId": str}
+    )
+    result = read_table(tmp_path / "layout", columns=columns).astype(
+        {"userId": str, "contractId": str}
+    )
+    pd.testing.assert_frame_equal(
+        result.sort_values(columns, ignore_index=True),
+        expected.sort_values(columns, ignore_index=True),
+    )
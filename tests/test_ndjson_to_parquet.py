@@ -0,0 +1,19 @@
+import pyarrow.parquet as pq
+
+from benchmark import write_json_samples
+from ndjson_to_parquet import convert_ndjson, parallel_ndjson_to_parquet
+
+
+def test_parallel_output_matches_single_process(synthetic_dir, tmp_path):
+    write_json_samples(synthetic_dir, 2_000)
+    ndjson_path = synthetic_dir / "bets.ndjson"
+    convert_ndjson(ndjson_path, tmp_path / "single.parquet", "bets")
+    # Small chunks, so there are many more chunks than the window of pending ones
+    parallel_ndjson_to_parquet(
+        ndjson_path, tmp_path / "parallel.parquet", "bets", workers=2, chunk_bytes=4096
+    )
+    single = pq.read_table(tmp_path / "single.parquet")
+    assert single.num_rows == 2_000
+    # Each chunk has its own dictionaries, so compare the decoded rows
+    parallel = pq.read_table(tmp_path / "parallel.parquet")
+    assert parallel.to_pylist() == single.to_pylist()
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from calculate_profits import calculate_profits
+from churn import SNAPSHOT_DATE, select_valid_users
+from churn_features import calculate_all_metrics
+from datasets import read_table
+from feature_store import open_feature_store
+from refresh import refresh
+
+
+def split_dumps(bets, dump_dir):
+    """
+    Write three growing dumps of the bets, the first ending partway through a millisecond
+    that has two identical bets, one on each side of the cut.
+    """
+    bets = bets.sort_values("createdTime", ignore_index=True)
+    first, second = len(bets) // 3, 2 * len(bets) // 3
+    tied = bets.index[first - 2 : first + 2]
+    bets.loc[tied, "createdTime"] = bets.loc[first, "createdTime"]
+    bets.loc[first] = bets.loc[first - 1]
+
+    paths = []
+    for i, end in enumerate([first, second, len(bets)]):
+        path = dump_dir / f"bets_{i}.parquet"
+        bets.iloc[:end].to_parquet(path)
+        paths.append(path)
+    return bets, paths
+
+
+def full_churn_metrics(bets, contracts, comments_path):
+    """
+    Churn metrics over every bet at once, selecting users and bets like churn.main.
+    """
+    bets = bets[["userId", "contractId", "createdTime"]].copy()
+    bets["createdTime"] = pd.to_datetime(bets["createdTime"], unit="ms")
+    bet_times = bets.groupby("userId", observed=True)["createdTime"].agg(
+        firstBetTime="min", lastBetTime="max"
+    )
+    valid_user_ids = select_valid_users(bet_times, SNAPSHOT_DATE)
+    bets = bets[
+        bets["userId"].isin(valid_user_ids) & bets["contractId"].isin(contracts["id"])
+    ]
+    comments = read_table(
+        comments_path,
+        columns=["userId", "likes", "createdTime"],
+        filter=ds.field("userId").isin(np.asarray(valid_user_ids, dtype=object)),
+    )
+    comments["createdTime"] = pd.to_datetime(comments["createdTime"], unit="ms")
+    contracts = contracts[["id", "creatorId", "createdTime"]].copy()
+    contracts["createdTime"] = pd.to_datetime(contracts["createdTime"], unit="ms")
+    return calculate_all_metrics(bets, contracts, comments, SNAPSHOT_DATE)
+
+
+def sorted_frame(df, keys):
+    df = df.astype({key: str for key in keys})
+    return df.sort_values(keys, ignore_index=True)
+
+
+def test_refreshed_dumps_match_full_run(synthetic_dir, tmp_path):
+    contracts_path = synthetic_dir / "contracts.parquet"
+    comments_path = synthetic_dir / "comments.parquet"
+    contracts = read_table(contracts_path)
+    bets, dump_paths = split_dumps(read_table(synthetic_dir / "bets.parquet"), tmp_path)
+
+    profits_path = tmp_path / "profits.parquet"
+    churn_path = tmp_path / "churn_2.parquet"
+    for bets_path in dump_paths:
+        refresh(
+            state_dir=tmp_path / "state",
+            bets_path=bets_path,
+            contracts_path=contracts_path,
+            comments_path=comments_path,
+            profits_path=profits_path,
+            churn_path=churn_path,
+            feature_store_path=tmp_path / "churn_features.arrow",
+        )
+
+    keys = ["userId", "contractId"]
+    expected = sorted_frame(calculate_profits(contracts, bets).to_pandas(), keys)
+    result = sorted_frame(pd.read_parquet(profits_path), keys)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
+
+    expected = sorted_frame(
+        full_churn_metrics(bets, contracts, comments_path), ["userId"]
+    )
+    result = sorted_frame(pd.read_parquet(churn_path), ["userId"])
+    assert len(expected)
+    pd.testing.assert_frame_equal(
+        result[expected.columns], expected, check_dtype=False, rtol=1e-9
+    )
+
+    # The feature store is rewritten with the churn table
+    store = open_feature_store(tmp_path / "churn_features.arrow").to_pandas()
+    store = sorted_frame(store, ["userId"])
+    pd.testing.assert_frame_equal(store[result.columns], result)
+    first_bet_times = bets.groupby(bets["userId"].astype(str))["createdTime"].min()
+    assert (
+        store["firstBetTime"]
+        == pd.to_datetime(first_bet_times[store["userId"]], unit="ms").to_numpy()
+    ).all()
+
+
+def test_refresh_is_idempotent_at_the_mark(synthetic_dir, tmp_path):
+    _, dump_paths = split_dumps(read_table(synthetic_dir / "bets.parquet"), tmp_path)
+    profits_path = tmp_path / "profits.parquet"
+    # Rereading a dump adds nothing, including its bets at the mark
+    for bets_path in [dump_paths[0], dump_paths[0], dump_paths[1], dump_paths[1]]:
+        refresh(
+            state_dir=tmp_path / "state",
+            bets_path=bets_path,
+            contracts_path=synthetic_dir / "contracts.parquet",
+            comments_path=synthetic_dir / "comments.parquet",
+            profits_path=profits_path,
+            churn_path=tmp_path / "churn_2.parquet",
+            feature_store_path=tmp_path / "churn_features.arrow",
+        )
+
+    keys = ["userId", "contractId"]
+    contracts = read_table(synthetic_dir / "contracts.parquet")
+    bets = read_table(dump_paths[1])
+    expected = sorted_frame(calculate_profits(contracts, bets).to_pandas(), keys)
+    result = sorted_frame(pd.read_parquet(profits_path), keys)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False, rtol=1e-9)
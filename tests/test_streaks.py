@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from churn import calculate_most_recent_streak, calculate_streak_metrics
+from churn_features import DAY_MS, calculate_all_streaks
+
+HOUR_MS = DAY_MS // 24
+
+
+def assert_same_streaks(users):
+    """
+    calculate_all_streaks over every user's bet times at once, against the per-user
+    functions in churn.py. users maps a user to their bet times in epoch milliseconds.
+    """
+    times = [np.sort(np.asarray(t, dtype=np.int64)) for t in users.values()]
+    ends = np.cumsum([len(t) for t in times])
+    starts = ends - [len(t) for t in times]
+    recent, longest, count = calculate_all_streaks(
+        np.concatenate(times) * 10**6, starts, ends
+    )
+    for i, user in enumerate(users):
+        dates = list(pd.to_datetime(times[i], unit="ms"))
+        metrics = calculate_streak_metrics(dates)
+        assert recent[i] == calculate_most_recent_streak(dates), user
+        assert longest[i] == metrics["longestDailyStreak"], user
+        assert count[i] == metrics["numDailyStreaks"], user
+
+
+def test_edge_cases_match_churn():
+    assert_same_streaks(
+        {
+            "one": [5 * DAY_MS],
+            "exact": [0, DAY_MS, 2 * DAY_MS],
+            "over": [0, DAY_MS, 2 * DAY_MS + 1],
+            "just under": [0, DAY_MS - 1, 3 * DAY_MS, 4 * DAY_MS - 1],
+            "duplicates": [0, 0, DAY_MS, DAY_MS, DAY_MS, 5 * DAY_MS, 5 * DAY_MS],
+            "same time": [DAY_MS] * 4,
+            "short runs": [0, HOUR_MS, 3 * DAY_MS, 3 * DAY_MS + HOUR_MS],
+        }
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_random_users_match_churn(seed):
+    rng = np.random.default_rng(seed)
+    gaps = np.array([0, 1, HOUR_MS, DAY_MS - 1, DAY_MS, DAY_MS + 1, 3 * DAY_MS])
+    users = {}
+    for user in range(50):
+        num_bets = rng.integers(1, 40)
+        # Mostly gaps around the 24 hour boundary, and some anywhere up to two days
+        boundary = rng.choice(gaps, num_bets)
+        anywhere = rng.integers(0, 2 * DAY_MS, num_bets)
+        times = np.cumsum(np.where(rng.random(num_bets) < 0.3, anywhere, boundary))
+        users[f"user-{user}"] = rng.permutation(times)
+    assert_same_streaks(users)
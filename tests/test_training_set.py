@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+
+from churn import select_valid_users
+from churn_features import calculate_all_metrics
+from datasets import read_table
+from training_set import build_training_set
+
+CUTOFFS = [
+    pd.Timestamp("2023-03-01"),
+    pd.Timestamp("2023-11-15"),
+    pd.Timestamp("2024-07-06"),
+]
+
+
+def truncated_metrics(bets, contracts, comments, cutoff):
+    """
+    Churn metrics of a dump ending at cutoff, selecting users and bets like churn.main,
+    with days since each user's first bet like the feature store.
+    """
+    bets, contracts, comments = (
+        df[df["createdTime"] < cutoff] for df in [bets, contracts, comments]
+    )
+    bet_times = bets.groupby("userId", observed=True)["createdTime"].agg(
+        firstBetTime="min", lastBetTime="max"
+    )
+    valid_user_ids = select_valid_users(bet_times, cutoff)
+    bets = bets[
+        bets["userId"].isin(valid_user_ids) & bets["contractId"].isin(contracts["id"])
+    ]
+    comments = comments[comments["userId"].isin(valid_user_ids)]
+    metrics = calculate_all_metrics(bets, contracts, comments, cutoff)
+    first_bet_times = bet_times["firstBetTime"].set_axis(bet_times.index.astype(str))
+    metrics["daysSinceFirstBet"] = (
+        cutoff - metrics["userId"].astype(str).map(first_bet_times)
+    ).dt.days
+    return metrics
+
+
+@pytest.fixture
+def inputs(synthetic_dir):
+    contracts = read_table(
+        synthetic_dir / "contracts.parquet", columns=["id", "creatorId", "createdTime"]
+    )
+    bets = read_table(
+        synthetic_dir / "bets.parquet", columns=["userId", "contractId", "createdTime"]
+    )
+    comments = read_table(
+        synthetic_dir / "comments.parquet", columns=["userId", "likes", "createdTime"]
+    )
+    return bets, contracts, comments
+
+
+def test_rows_match_truncated_dumps(inputs):
+    bets, contracts, comments = inputs
+    rows = build_training_set(
+        bets, contracts["id"].unique(), contracts, comments, CUTOFFS
+    )
+
+    as_datetimes = [
+        df.assign(createdTime=pd.to_datetime(df["createdTime"], unit="ms"))
+        for df in inputs
+    ]
+    for cutoff in CUTOFFS:
+        expected = truncated_metrics(*as_datetimes, cutoff)
+        expected["userId"] = expected["userId"].astype(str)
+        result = rows[rows["cutoff"] == cutoff].reset_index(drop=True)
+        assert len(expected)
+        columns = [c for c in result.columns if c in expected.columns]
+        assert columns == [c for c in result.columns if c != "cutoff"]
+        pd.testing.assert_frame_equal(
+            result[columns].sort_values("userId", ignore_index=True),
+            expected[columns].sort_values("userId", ignore_index=True),
+            check_dtype=False,
+        )
@@ -0,0 +1,148 @@
+"""
+Per-user features of the topics (groupSlugs) of the markets they bet on.
+
+Contracts are mapped to their topics once with a CSR index taken from the offsets of the
+groupSlugs list column, so a bet is joined to its topics by slicing integer arrays rather
+than exploding lists. A bet on a market in k topics counts 1/k towards each of them. For
+the 7 and 30 days up to each user's last bet this gives the number of distinct topics,
+the entropy of the user's activity over topics in nats, and the share of it in their top
+topic. Users whose bets in a window have no topics get NaN entropy and share.
+"""
+
+import argparse
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from churn_features import DAY_MS, WINDOWS
+from datasets import lookup_codes, read_table
+
+
+@dataclass
+class TopicIndex:
+    """
+    Topics of contract i are topic_codes[offsets[i] : offsets[i + 1]], coded into topics.
+    """
+
+    contract_ids: pd.Index
+    offsets: np.ndarray
+    topic_codes: np.ndarray
+    topics: pa.Array
+
+
+def build_topic_index(contracts):
+    """
+    CSR index from the position of each contract to its integer-coded topics.
+    """
+    slugs = pa.array(contracts["groupSlugs"], type=pa.list_(pa.string()))
+    slugs = pc.fill_null(slugs, pa.scalar([], type=slugs.type))
+    offsets = slugs.offsets.to_numpy()
+    topics = slugs.flatten().dictionary_encode()
+    return TopicIndex(
+        contract_ids=pd.Index(contracts["id"]),
+        offsets=offsets - offsets[0],
+        topic_codes=topics.indices.to_numpy(),
+        topics=topics.dictionary,
+    )
+
+
+def _expand_topics(index, contract_positions):
+    """
+    One (bet, topic) pair per topic of each bet's contract, with the bet's 1/k weight.
+    """
+    starts = index.offsets[contract_positions]
+    counts = index.offsets[contract_positions + 1] - starts
+    pair_bets = np.repeat(np.arange(len(contract_positions)), counts)
+    # Offset of each pair within its bet's slice of the topic codes
+    within = np.arange(len(pair_bets)) - np.repeat(np.cumsum(counts) - counts, counts)
+    pair_topics = index.topic_codes[starts[pair_bets] + within]
+    return pair_bets, pair_topics, 1 / counts[pair_bets]
+
+
+def calculate_topic_metrics(bets, index):
+    """
+    Topic features for every user in bets, with createdTime in epoch milliseconds.
+    """
+    codes, user_ids = pd.factorize(bets["userId"])
+    num_users = len(user_ids)
+    num_topics = len(index.topics)
+    times = bets["createdTime"].to_numpy(dtype=np.int64)
+    last_bet_times = np.full(num_users, np.iinfo(np.int64).min)
+    np.maximum.at(last_bet_times, codes, times)
+
+    contract_positions = lookup_codes(index.contract_ids, bets["contractId"])
+    has_contract = contract_positions >= 0
+    bet_rows = np.flatnonzero(has_contract)
+    pair_bets, pair_topics, pair_weights = _expand_topics(
+        index, contract_positions[has_contract]
+    )
+    pair_bets = bet_rows[pair_bets]
+    pair_users = codes[pair_bets]
+
+    metrics = {}
+    for window in WINDOWS:
+        in_window = times[pair_bets] >= last_bet_times[pair_users] - window * DAY_MS
+        keys, inverse = np.unique(
+            pair_users[in_window].astype(np.int64) * num_topics
+            + pair_topics[in_window],
+            return_inverse=True,
+        )
+        weights = np.bincount(inverse, weights=pair_weights[in_window])
+        users = keys // num_topics
+
+        totals = np.bincount(users, weights=weights, minlength=num_users)
+        shares = weights / totals[users]
+        has_topics = totals > 0
+        entropy = np.full(num_users, np.nan)
+        entropy[has_topics] = np.bincount(
+            users, weights=-shares * np.log(shares), minlength=num_users
+        )[has_topics]
+        # Keys are sorted, so each user's topics are contiguous
+        top_share = np.full(num_users, np.nan)
+        user_starts = np.flatnonzero(np.diff(users, prepend=-1) != 0)
+        if len(user_starts):
+            top_share[users[user_starts]] = np.maximum.reduceat(shares, user_starts)
+
+        metrics[f"numTopicsLast{window}Days"] = np.bincount(users, minlength=num_users)
+        metrics[f"topicEntropyLast{window}Days"] = entropy
+        metrics[f"topTopicShareLast{window}Days"] = top_share
+
+    return pd.DataFrame(
+        {"userId": np.asarray(user_ids, dtype=object), **metrics}
+    ).sort_values("userId", ignore_index=True)
+
+
+def main(
+    bets_path="manifold_datasets/bets.parquet",
+    churn_path="manifold_datasets/churn_2.parquet",
+    output_path="manifold_datasets/topics.parquet",
+):
+    user_ids = pd.read_parquet(churn_path, columns=["userId"])["userId"].unique()
+    contracts = read_table(
+        "manifold_datasets/contracts.parquet", columns=["id", "groupSlugs"]
+    ).drop_duplicates("id", keep="last")
+    # The same bets as churn.py, so windows end at the same last bet
+    bets = read_table(
+        bets_path,
+        columns=["userId", "contractId", "createdTime"],
+        filter=ds.field("userId").isin(np.asarray(user_ids, dtype=object))
+        & ds.field("contractId").isin(contracts["id"].to_numpy()),
+    )
+    metrics = calculate_topic_metrics(bets, build_topic_index(contracts))
+    metrics.to_parquet(output_path)
+    print(f"Wrote {len(metrics)} records to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--bets",
+        default="manifold_datasets/bets.parquet",
+        help="bets file, or a directory written by layout_bets.py",
+    )
+    args = parser.parse_args()
+    main(bets_path=args.bets)
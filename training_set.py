@@ -0,0 +1,204 @@
+"""
+Build churn training rows for many cutoff dates from a single pass over the bets.
+
+Each (user, cutoff) row has the churn features a dump ending at the cutoff would have
+given, for the users churn.py would have selected at that snapshot. Bets, contracts and
+comments are sorted by (user, time) once, and every cutoff only binary searches each
+user's events and differences prefix sums, so a cutoff costs O(users * log(events))
+rather than another pass over the bets.
+
+Only the features that reduce to counts and prefix sums are built: bets, betting days,
+contracts created, comments and comment likes in the last 7 and 30 days, the daily
+streak, and days since the first and last bet. The per-market medians and spreads of
+churn_features need the full windows and are left out.
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from churn import select_valid_users
+from churn_features import DAY_MS, WINDOWS, UserEvents, prefix_sum
+from datasets import lookup_codes, read_table
+
+
+def _to_ms(date):
+    return pd.Timestamp(date).value // 10**6
+
+
+def build_training_set(bets, market_ids, contracts, comments, cutoffs):
+    """
+    Features of every user selected at each cutoff, from bets, contracts and comments
+    created before it.
+
+    bets holds every bet with userId, contractId and createdTime, in epoch milliseconds
+    like the converted tables. Only bets on contracts in market_ids count towards
+    features, while all bets count towards selecting users, as in churn.main.
+    """
+    codes, user_ids = pd.factorize(bets["userId"], sort=True)
+    user_ids = pd.Index(np.asarray(user_ids, dtype=object))
+    num_users = len(user_ids)
+    times = bets["createdTime"].to_numpy(dtype=np.int64)
+    on_market = bets["contractId"].isin(market_ids).to_numpy()
+    cutoff_times = np.array([_to_ms(cutoff) for cutoff in cutoffs], dtype=np.int64)
+
+    creator_codes = lookup_codes(user_ids, contracts["creatorId"])
+    by_creator = creator_codes >= 0
+    contract_times = contracts["createdTime"].to_numpy(dtype=np.int64)[by_creator]
+    creator_codes = creator_codes[by_creator]
+
+    comment_codes = lookup_codes(user_ids, comments["userId"])
+    by_commenter = comment_codes >= 0
+    comment_times = comments["createdTime"].to_numpy(dtype=np.int64)[by_commenter]
+    comment_codes = comment_codes[by_commenter]
+
+    # Searches go as far back as the longest window before the earliest event
+    all_times = [
+        a for a in [times, contract_times, comment_times, cutoff_times] if len(a)
+    ]
+    origin = min(a.min() for a in all_times) - max(WINDOWS) * DAY_MS
+    span = max(a.max() for a in all_times) - origin + 1
+    shift = int(span).bit_length()
+    if num_users.bit_length() + shift > 62:
+        raise ValueError("too many users to pack with their event times")
+
+    all_bets = UserEvents(codes, times, origin, shift)
+    market_bets = UserEvents(codes[on_market], times[on_market], origin, shift)
+    created = UserEvents(creator_codes, contract_times, origin, shift)
+    commented = UserEvents(comment_codes, comment_times, origin, shift)
+
+    users = np.arange(num_users)
+    all_starts = all_bets.position(users, np.full(num_users, origin))
+    starts = market_bets.position(users, np.full(num_users, origin))
+
+    # Betting days are counted from where the day changes within a user's bets
+    bet_times = market_bets.times
+    is_group_start = np.diff(market_bets.codes, prepend=-1) != 0
+    days = bet_times // DAY_MS
+    new_days = prefix_sum(is_group_start | (days != np.r_[days[:1], days[:-1]]))
+    # Streaks restart at the first bet of a user or after a gap of over 24 hours
+    gaps = np.diff(bet_times, prepend=bet_times[:1])
+    streak_starts = np.maximum.accumulate(
+        np.where(is_group_start | (gaps > DAY_MS), np.arange(len(bet_times)), 0)
+    )
+    likes = prefix_sum(comments["likes"].to_numpy()[by_commenter][commented.order])
+
+    frames = []
+    for cutoff, cutoff_time in zip(cutoffs, cutoff_times):
+        at_cutoff = np.full(num_users, cutoff_time)
+        all_ends = all_bets.position(users, at_cutoff)
+        has_bets = all_ends > all_starts
+        bet_times_before = pd.DataFrame(
+            {
+                "firstBetTime": pd.to_datetime(
+                    all_bets.times[all_starts[has_bets]], unit="ms"
+                ),
+                "lastBetTime": pd.to_datetime(
+                    all_bets.times[all_ends[has_bets] - 1], unit="ms"
+                ),
+            },
+            index=users[has_bets],
+        )
+        selected = select_valid_users(bet_times_before, pd.Timestamp(cutoff))
+
+        ends = market_bets.position(selected, at_cutoff[selected])
+        has_market_bets = ends > starts[selected]
+        selected = selected[has_market_bets]
+        ends = ends[has_market_bets]
+        last_bet_times = bet_times[ends - 1]
+        cutoff_times_selected = at_cutoff[selected]
+
+        contract_metrics = {}
+        comment_likes = {}
+        comment_counts = {}
+        bet_counts = {}
+        for window in WINDOWS:
+            thresholds = last_bet_times - window * DAY_MS
+
+            contract_metrics[f"numContractsCreatedLast{window}Days"] = created.position(
+                selected, cutoff_times_selected
+            ) - created.position(selected, thresholds)
+
+            comment_ends = commented.position(selected, cutoff_times_selected)
+            comment_starts = commented.position(selected, thresholds)
+            comment_likes[f"numCommentLikesLast{window}Days"] = (
+                likes[comment_ends] - likes[comment_starts]
+            )
+            comment_counts[f"numCommentsLast{window}Days"] = (
+                comment_ends - comment_starts
+            )
+
+            window_starts = market_bets.position(selected, thresholds)
+            bet_counts[f"bettingDaysLast{window}Days"] = (
+                1 + new_days[ends] - new_days[window_starts + 1]
+            )
+            bet_counts[f"numBetsLast{window}Days"] = ends - window_starts
+
+        frames.append(
+            pd.DataFrame(
+                {
+                    "userId": user_ids[selected],
+                    "cutoff": pd.Timestamp(cutoff),
+                    "daysSinceLastBet": (cutoff_times_selected - last_bet_times)
+                    // DAY_MS,
+                    **contract_metrics,
+                    **comment_likes,
+                    **comment_counts,
+                    **bet_counts,
+                    "dailyStreak": (
+                        (last_bet_times - bet_times[streak_starts[ends - 1]]) // DAY_MS
+                    ).astype(np.float64),
+                    "daysSinceFirstBet": (
+                        cutoff_times_selected - all_bets.times[all_starts[selected]]
+                    )
+                    // DAY_MS,
+                }
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
+
+
+def main(
+    cutoffs,
+    bets_path="manifold_datasets/bets.parquet",
+    output_path="manifold_datasets/churn_training.parquet",
+):
+    contracts = read_table(
+        "manifold_datasets/contracts.parquet",
+        columns=["id", "creatorId", "createdTime"],
+    )
+    bets = read_table(bets_path, columns=["userId", "contractId", "createdTime"])
+    comments = read_table(
+        "manifold_datasets/comments.parquet",
+        columns=["userId", "likes", "createdTime"],
+    )
+    # Contracts and comments made after the last cutoff can't be counted by any row
+    last_cutoff = max(_to_ms(cutoff) for cutoff in cutoffs)
+    contracts = contracts[contracts["createdTime"] < last_cutoff]
+    comments = comments[comments["createdTime"] < last_cutoff]
+
+    rows = build_training_set(
+        bets, contracts["id"].unique(), contracts, comments, cutoffs
+    )
+    rows.to_parquet(output_path)
+    print(f"Wrote {len(rows)} rows for {len(cutoffs)} cutoffs to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--start", default="2022-07-06", help="first cutoff date")
+    parser.add_argument("--end", default="2024-07-06", help="last cutoff date")
+    parser.add_argument("--every", type=int, default=7, help="days between cutoffs")
+    parser.add_argument(
+        "--bets",
+        default="manifold_datasets/bets.parquet",
+        help="bets file, or a directory written by layout_bets.py",
+    )
+    parser.add_argument("--output", default="manifold_datasets/churn_training.parquet")
+    args = parser.parse_args()
+    main(
+        list(pd.date_range(args.start, args.end, freq=f"{args.every}D")),
+        bets_path=args.bets,
+        output_path=args.output,
+    )